@@ -6,20 +6,45 @@ Flask + LINE Messaging API v3
 
 import os
 import io
+import sys
 import json
 import uuid
+import time
+import atexit
+import contextlib
+import contextvars
+import signal
 import logging
+import logging.handlers
+import threading
 import traceback
+import re
+import random
+import hashlib
+import hmac
+import ipaddress
+import mimetypes
+import sqlite3
 import calendar
+import functools
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import requests as http_requests
+import urllib3
 from datetime import datetime, timedelta, date
 
-from flask import Flask, request, abort, send_from_directory, jsonify
+from flask import Flask, Response, request, abort, jsonify
+from werkzeug.security import safe_join
 from linebot.v3 import WebhookHandler
 from linebot.v3.messaging import (
     MessagingApi,
     Configuration,
     ApiClient,
+    ApiException,
 )
 from linebot.v3.messaging.models import (
     TextMessage,
@@ -41,9 +66,16 @@ from linebot.v3.webhooks import (
 )
 from linebot.v3.exceptions import InvalidSignatureError
 
-from openai import OpenAI
-from PIL import Image, ImageDraw, ImageFont
-import tweepy
+from calendar_render import (
+    THERAPIST_COLORS,
+    CALENDAR_THEMES,
+    CALENDAR_FONT_SPECS,
+    fonts,
+    render_calendar_images,
+    init_render_worker,
+)
+
+# openai・tweepy・Pillowは読み込みに時間がかかるため、初回利用時に関数内でimportする（get_openai_client / warm_up 参照）
 
 # ─── ログ設定 ───
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -56,31 +88,92 @@ CHANNEL_ACCESS_TOKEN = os.environ.get(
     "6cPZ0W6arhy1odKsdbt1U5o0AjQ2WxiDtw7qIwrK2IVDBWnhaYl+GYyjvZpoGz/v6Yc+idHkYsyFqQ2DjpmoS7L5F8PUdOxoDJwLha01/JfD7t0bn7WGrO0d6Ic+L8bPUpAEDCbYrgI2UDqQiaXokQdB04t89/1O/w1cDnyilFU=",
 )
 ADMIN_USER_ID = os.environ.get("LINE_ADMIN_USER_ID", "U485fac63c62459cb069c64a1a9846595")
+# /stats などの診断用エンドポイントのトークン（未設定ならlocalhostからのアクセスのみ許可）
+DIAGNOSTICS_TOKEN = os.environ.get("DIAGNOSTICS_TOKEN", "")
 
 # Notion API
 NOTION_API_KEY = os.environ.get("NOTION_API_KEY", "")
 NOTION_DATABASE_ID = os.environ.get("NOTION_DATABASE_ID", "256f9507f0cf8076931fed70fc040520")
 NOTION_NEWS_DATABASE_ID = os.environ.get("NOTION_NEWS_DATABASE_ID", "74dde0685a7a4ee09aeb67e53658e63e")
+NOTION_POOL_SIZE = int(os.environ.get("NOTION_POOL_SIZE", "10"))
+NOTION_CONNECT_TIMEOUT = float(os.environ.get("NOTION_CONNECT_TIMEOUT", "5"))
+NOTION_READ_TIMEOUT = float(os.environ.get("NOTION_READ_TIMEOUT", "30"))
+NOTION_MAX_RETRIES = int(os.environ.get("NOTION_MAX_RETRIES", "3"))
+NOTION_API_BASE_URL = os.environ.get("NOTION_API_BASE_URL", "https://api.notion.com/v1").rstrip("/")
+
+# LINE Messaging API
+LINE_POOL_SIZE = int(os.environ.get("LINE_POOL_SIZE", "10"))
+LINE_CONNECT_TIMEOUT = float(os.environ.get("LINE_CONNECT_TIMEOUT", "5"))
+LINE_READ_TIMEOUT = float(os.environ.get("LINE_READ_TIMEOUT", "30"))
+LINE_MAX_RETRIES = int(os.environ.get("LINE_MAX_RETRIES", "3"))
+LINE_API_BASE_URL = os.environ.get("LINE_API_BASE_URL", "https://api.line.me").rstrip("/")
+SHIFT_CACHE_TTL = float(os.environ.get("SHIFT_CACHE_TTL", "300"))
+SHIFT_CACHE_MAX_STALE = float(os.environ.get("SHIFT_CACHE_MAX_STALE", "3600"))
+# 「出勤情報 N」の最大日数（1日5名程度なら1つのバブルに全件収まる範囲）
+MAX_UPCOMING_DAYS = 14
+# LINEのバブルは30KBまで。出勤情報の行はこの大きさを超えない分だけ入れ、残りは「ほかN件」にまとめる
+# （ヘッダー・戻るボタン・「ほかN件」の分として2KBほど空けておく）
+UPCOMING_FLEX_MAX_BYTES = 28 * 1000
+SHIFT_MIRROR_PATH = os.environ.get("SHIFT_MIRROR_PATH", "")
+SHIFT_SYNC_INTERVAL = float(os.environ.get("SHIFT_SYNC_INTERVAL", "60"))
+SHIFT_FULL_SYNC_INTERVAL = float(os.environ.get("SHIFT_FULL_SYNC_INTERVAL", "3600"))
 
 # X (Twitter) API
 X_API_KEY = os.environ.get("X_API_KEY", "").strip()
 X_API_KEY_SECRET = os.environ.get("X_API_KEY_SECRET", "").strip()
 X_ACCESS_TOKEN = os.environ.get("X_ACCESS_TOKEN", "").strip()
 X_ACCESS_TOKEN_SECRET = os.environ.get("X_ACCESS_TOKEN_SECRET", "").strip()
+X_API_BASE_URL = os.environ.get("X_API_BASE_URL", "https://api.x.com").rstrip("/")
+
+# Webhook非同期処理（署名検証後すぐに200を返し、ワーカースレッドでイベントを処理する）
+WEBHOOK_ASYNC = os.environ.get("WEBHOOK_ASYNC", "").lower() in ("1", "true", "yes")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "200"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "25"))
+WARM_UP = os.environ.get("WARM_UP", "").lower() in ("1", "true", "yes")
+
+# ニュース生成ジョブ（プロセスあたりのOpenAI同時呼び出し数の上限）
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "4"))
+# 1回の生成リクエストで作る下書きの数（2件目以降は「再生成」ですぐに表示する）
+# 出力トークンは下書きの数に比例して増え、多くの場合は1件目がそのまま使われるため、既定では先読みしない
+NEWS_DRAFTS = max(1, int(os.environ.get("NEWS_DRAFTS", "1")))
+
+# メトリクス
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+# トレース
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_DIR = os.environ.get("TRACE_DIR", "data/traces")
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.environ.get("TRACE_BACKUP_COUNT", "3"))
+
+# プロファイラ（管理者の「プロファイル」コマンド）
+# static/ 以下はFlaskが誰にでも配信するため、プロファイルはその外に置き /profiles/<ファイル名> で配信する
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "600"))
+PROFILE_MAX_EVENTS = int(os.environ.get("PROFILE_MAX_EVENTS", "200"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "10"))
 
 # ─── Flask ───
 app = Flask(__name__)
 
 # ─── LINE SDK v3 ───
-configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
+configuration = Configuration(host=LINE_API_BASE_URL, access_token=CHANNEL_ACCESS_TOKEN)
+configuration.connection_pool_maxsize = LINE_POOL_SIZE
 handler = WebhookHandler(CHANNEL_SECRET)
 
 def get_messaging_api():
-    api_client = ApiClient(configuration)
-    return MessagingApi(api_client)
+    """プロセス内で共有するLINEクライアントを返す（line_client）"""
+    return line_client
 
 # ─── OpenAI ───
-openai_client = OpenAI()
+@functools.lru_cache(maxsize=None)
+def get_openai_client():
+    """OpenAIクライアントを初回利用時に作成して返す"""
+    from openai import OpenAI
+    return OpenAI()
 
 # ─── 店舗情報 ───
 SHOP_INFO = {
@@ -91,11 +184,14 @@ SHOP_INFO = {
 }
 
 # ─── セッション管理 ───
-user_sessions = {}
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(6 * 3600)))
+SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", "10000"))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", os.path.join(os.path.dirname(__file__), "data", "sessions.sqlite3"))
 
 # ─── 画像保存ディレクトリ ───
 UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "static", "images")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # ─── BASE_URL（トンネル公開後に設定） ───
 BASE_URL = os.environ.get("BASE_URL", "https://zenryoku-line-bot-production.up.railway.app")
@@ -113,41 +209,665 @@ def parse_date_safe(date_str):
         return None
 
 
-# ─── セラピスト色分け ───
-THERAPIST_COLORS = [
-    "#FF6B9D",  # ピンク
-    "#C084FC",  # パープル
-    "#60A5FA",  # ブルー
-    "#34D399",  # グリーン
-    "#FBBF24",  # イエロー
-    "#FB923C",  # オレンジ
-    "#F87171",  # レッド
-    "#A78BFA",  # バイオレット
-    "#2DD4BF",  # ティール
-    "#E879F9",  # マゼンタ
-    "#FCA5A5",  # ライトレッド
-    "#86EFAC",  # ライトグリーン
-    "#93C5FD",  # ライトブルー
-    "#FDE68A",  # ライトイエロー
-    "#FDBA74",  # ライトオレンジ
-]
+# ─── SQLite接続ヘルパー ───
+def thread_sqlite_connection(local, path):
+    """スレッドごと（fork後はプロセスごと）に使い回すSQLite接続（WALモード）を返す"""
+    conn = getattr(local, "conn", None)
+    if conn is None or getattr(local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+# ─── カレンダー画像（描画処理は calendar_render.py） ───
+CALENDAR_THEME = os.environ.get("CALENDAR_THEME", "dark")
+if CALENDAR_THEME not in CALENDAR_THEMES:
+    # 描画ワーカーでKeyErrorになり続けないよう、起動時に既定のテーマへ戻す
+    logger.warning(f"Unknown CALENDAR_THEME={CALENDAR_THEME!r} (available: {', '.join(CALENDAR_THEMES)}), using 'dark'")
+    CALENDAR_THEME = "dark"
+CALENDAR_IMAGE_FORMAT = os.environ.get("CALENDAR_IMAGE_FORMAT", "png8")
+CALENDAR_IMAGE_EXTENSIONS = {"png8": "png", "png": "png", "jpeg": "jpg"}
+CALENDAR_PREVIEW_WIDTH = int(os.environ.get("CALENDAR_PREVIEW_WIDTH", "240"))
+IMAGE_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_BYTES", str(32 * 1024 * 1024)))
+IMAGE_STORE_MAX_BYTES = int(os.environ.get("IMAGE_STORE_MAX_BYTES", str(200 * 1024 * 1024)))
+IMAGE_MAX_AGE_HOURS = float(os.environ.get("IMAGE_MAX_AGE_HOURS", "72"))
+IMAGE_PROTECT_HOURS = float(os.environ.get("IMAGE_PROTECT_HOURS", "24"))
+IMAGE_JANITOR_INTERVAL = float(os.environ.get("IMAGE_JANITOR_INTERVAL", "600"))
+CALENDAR_RENDER_PROCESSES = int(os.environ.get("CALENDAR_RENDER_PROCESSES", "0"))
+CALENDAR_RENDER_TIMEOUT = float(os.environ.get("CALENDAR_RENDER_TIMEOUT", "15"))
+
+
+# ═══════════════════════════════════════════
+#  メトリクス
+# ═══════════════════════════════════════════
+
+class LatencyHistogram:
+    """レイテンシ（ms）の累積ヒストグラム。パーセンタイルはバケット上限で近似する"""
+
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * len(self.BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def observe(self, elapsed_ms):
+        index = bisect_left(self.BUCKETS_MS, elapsed_ms)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += elapsed_ms
+
+    @classmethod
+    def percentile_of(cls, counts, q):
+        """バケットごとの件数からパーセンタイル（バケット上限）を求める"""
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(cls.BUCKETS_MS, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return cls.BUCKETS_MS[-1]
+
+    def percentile(self, q):
+        with self._lock:
+            counts = list(self.counts)
+        return self.percentile_of(counts, q)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): n
+                        for bound, n in zip(self.BUCKETS_MS, self.counts)},
+        }
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, **extra):
+    """Prometheusのラベル表記 {k="v",...}"""
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in items) + "}"
+
+
+class MetricsRegistry:
+    """/metrics で公開するヒストグラムとカウンターのプロセス内レジストリ
+
+    記録はロック1つと配列の加算だけで済ませる。METRICS_DIR を設定すると各プロセスが自分の値を
+    <pid>.json に定期的に書き出し、/metrics では全プロセス分を合算して返す（gunicornの複数workerでも
+    どのworkerがスクレイプを受けても同じ値になる）。
+    """
+
+    HELP = {
+        "zenryoku_command_duration_seconds": "Time spent handling a text command in handle_text_message.",
+        "zenryoku_command_errors_total": "Text commands that raised an exception.",
+        "zenryoku_stage_duration_seconds": "Time spent in a processing stage (Notion, OpenAI, X, calendar rendering, LINE API).",
+        "zenryoku_stage_errors_total": "Failed calls per processing stage.",
+        "zenryoku_news_job_duration_seconds": "Time from submitting a news generation job to its outcome.",
+        "zenryoku_news_jobs_total": "Finished news generation jobs by outcome (completed, cancelled, superseded, failed).",
+        "zenryoku_news_draft_buffer_total": "News regenerations served from the session's draft buffer (hit) or by a new generation (miss).",
+        "zenryoku_openai_tokens_total": "OpenAI tokens spent on news generation.",
+        "zenryoku_news_saved_total": "News articles saved to Notion.",
+    }
+
+    def __init__(self, directory="", flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._flusher_pid = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def histogram(self, name, **labels):
+        """ヒストグラムを取得（なければ作成）。繰り返し記録する呼び出し元は保持して使い回せる"""
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe(self, name, elapsed_ms, **labels):
+        self.histogram(name, **labels).observe(elapsed_ms)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def timed(self, prefix, **labels):
+        """ブロックの所要時間を <prefix>_duration_seconds に記録し、例外は <prefix>_errors_total に数える
+
+        ラベルのdictをyieldするため、ブロック内で書き換えたラベルで記録される。
+        """
+        started = time.perf_counter()
+        try:
+            yield labels
+        except Exception:
+            self.inc(f"{prefix}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(f"{prefix}_duration_seconds", (time.perf_counter() - started) * 1000, **labels)
+
+    def snapshot(self):
+        """このプロセスの値（JSONにできる形）"""
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = list(self._counters.items())
+        return {
+            "histograms": [[name, list(labels), list(h.counts), h.total_ms] for (name, labels), h in histograms],
+            "counters": [[name, list(labels), value] for (name, labels), value in counters],
+        }
+
+    # ─── 複数プロセス ───
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        """このプロセスの値を METRICS_DIR/<pid>.json に書き出す"""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start(self):
+        """METRICS_DIR がある場合、プロセスごとに定期書き出しスレッドを起動する"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Metrics flush failed: {e}")
+
+    def _collect(self):
+        """全プロセス分（METRICS_DIR未設定ならこのプロセス分）を合算した値"""
+        if not self.directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        histograms = {}
+        counters = {}
+        for snap in snapshots:
+            for name, labels, counts, total_ms in snap["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total_ms
+            for name, labels, value in snap["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    def summary(self, prefix, label):
+        """<prefix>_duration_seconds と <prefix>_errors_total をラベルの値ごとにまとめる（全プロセス合算）"""
+        histograms, counters = self._collect()
+        rows = {}
+
+        def row(labels):
+            key = dict(labels).get(label)
+            return rows.setdefault(key, {label: key, "count": 0, "p50_ms": None, "p95_ms": None, "errors": 0})
+
+        for (name, labels), (counts, _total_ms) in histograms.items():
+            if name == f"{prefix}_duration_seconds":
+                entry = row(labels)
+                entry["count"] = sum(counts)
+                entry["p50_ms"] = LatencyHistogram.percentile_of(counts, 0.5)
+                entry["p95_ms"] = LatencyHistogram.percentile_of(counts, 0.95)
+        for (name, labels), value in counters.items():
+            if name == f"{prefix}_errors_total":
+                row(labels)["errors"] += value
+        return [entry for entry in rows.values() if entry["count"] or entry["errors"]]
+
+    def render(self):
+        """Prometheusのテキスト形式"""
+        histograms, counters = self._collect()
+        lines = []
+        for metric in sorted({name for name, _ in histograms}):
+            lines.append(f"# HELP {metric} {self.HELP.get(metric, metric)}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (name, labels), (counts, total_ms) in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, n in zip(LatencyHistogram.BUCKETS_MS, counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else f"{bound / 1000:g}"
+                    lines.append(f"{name}_bucket{format_labels(labels, le=le)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total_ms / 1000:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for metric in sorted({name for name, _ in counters}):
+            lines.append(f"# HELP {metric} {self.HELP.get(metric, metric)}")
+            lines.append(f"# TYPE {metric} counter")
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+atexit.register(metrics.flush)
+
+
+def timed_stage(stage):
+    """関数の所要時間を zenryoku_stage_duration_seconds{stage=...} に記録し、トレースのスパンにするデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timed("zenryoku_stage", stage=stage), tracer.span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_stage_error(stage):
+    """例外を握りつぶして失敗を返す関数の失敗を数える"""
+    metrics.inc("zenryoku_stage_errors_total", stage=stage)
+
+
+# ═══════════════════════════════════════════
+#  トレース
+# ═══════════════════════════════════════════
+
+class Span:
+    """トレース内の1区間（開始はトレース開始からのオフセットで持つ）"""
+
+    __slots__ = ("span_id", "parent_id", "name", "offset_ms", "duration_ms", "attrs", "error")
+
+    def __init__(self, span_id, parent_id, name, offset_ms, attrs):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.offset_ms = offset_ms
+        self.duration_ms = None
+        self.attrs = attrs
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        data = {"id": self.span_id, "parent": self.parent_id, "name": self.name,
+                "offset_ms": round(self.offset_ms, 2), "duration_ms": round(self.duration_ms or 0, 2)}
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+class Trace:
+    """1つのWebhookイベントの処理で記録したスパンの集まり"""
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def elapsed_ms(self, at=None):
+        return ((at or time.perf_counter()) - self.started) * 1000
+
+    def new_span(self, parent, name, attrs, offset_ms=None):
+        span = Span(len(self.spans), parent.span_id if parent else None, name,
+                    self.elapsed_ms() if offset_ms is None else offset_ms, attrs)
+        self.spans.append(span)
+        return span
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Tracer:
+    """Webhookイベント単位の軽量トレース
+
+    trace() でイベントの処理全体をルートスパンとして開始し（トレースIDはwebhookEventId）、
+    span() で入れ子の区間を記録する。現在のスパンはcontextvarsで引き継ぐため、呼び出し元から渡す必要はない。
+    サンプリングされなかったイベントでは span() は何もしない。
+    完了したトレースは1行1トレースのJSONとして <TRACE_DIR>/traces-<pid>.jsonl に追記し、サイズでローテーションする。
+    """
+
+    def __init__(self, directory, sample_rate=0.0, max_bytes=10 * 1024 * 1024, backup_count=3):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handler = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.sampled = 0
+        self.exported = 0
+        self.export_errors = 0
+
+    def _get_handler(self):
+        # ローテーションが競合しないよう、プロセスごとに別ファイルへ書く
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    os.makedirs(self.directory, exist_ok=True)
+                    handler = logging.handlers.RotatingFileHandler(
+                        os.path.join(self.directory, f"traces-{os.getpid()}.jsonl"),
+                        maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8", delay=True)
+                    handler.setFormatter(logging.Formatter("%(message)s"))
+                    self._handler = handler
+                    self._pid = os.getpid()
+        return self._handler
+
+    @contextlib.contextmanager
+    def trace(self, name, trace_id=None, **attrs):
+        """ルートスパンを開始する（サンプリングされなければ何も記録しない）"""
+        self.traces += 1
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield None
+            return
+        self.sampled += 1
+        trace = Trace(trace_id or uuid.uuid4().hex)
+        root = trace.new_span(None, name, attrs)
+        token = _current_trace.set((trace, root))
+        try:
+            yield root
+        except Exception as e:
+            root.error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            root.duration_ms = trace.elapsed_ms() - root.offset_ms
+            _current_trace.reset(token)
+            self._export(trace)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """現在のトレースに子スパンを記録する"""
+        current = _current_trace.get()
+        if current is None:
+            yield None
+            return
+        trace, parent = current
+        span = trace.new_span(parent, name, attrs)
+        token = _current_trace.set((trace, span))
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            span.duration_ms = trace.elapsed_ms() - span.offset_ms
+            _current_trace.reset(token)
+
+    def record(self, name, started, duration_ms, **attrs):
+        """別プロセスなどで計測済みの区間を、perf_counterの開始時刻と所要時間から子スパンとして追加する"""
+        current = _current_trace.get()
+        if current is None:
+            return
+        trace, parent = current
+        span = trace.new_span(parent, name, attrs, offset_ms=trace.elapsed_ms(started))
+        span.duration_ms = duration_ms
+
+    def annotate(self, **attrs):
+        """現在のスパンに属性を追加する"""
+        current = _current_trace.get()
+        if current is not None:
+            current[1].set(**attrs)
+
+    def _export(self, trace):
+        root = trace.spans[0]
+        line = json.dumps({
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "start": datetime.fromtimestamp(trace.started_at).isoformat(timespec="milliseconds"),
+            "duration_ms": round(root.duration_ms, 2),
+            "pid": os.getpid(),
+            "error": root.error,
+            "spans": [span.to_dict() for span in trace.spans],
+        }, ensure_ascii=False, default=str)
+        try:
+            self._get_handler().handle(logging.makeLogRecord({"msg": line}))
+            self.exported += 1
+        except Exception as e:
+            self.export_errors += 1
+            logger.warning(f"Trace export failed: {e}")
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "directory": self.directory,
+            "traces": self.traces,
+            "sampled": self.sampled,
+            "exported": self.exported,
+            "export_errors": self.export_errors,
+        }
+
+
+tracer = Tracer(TRACE_DIR, TRACE_SAMPLE_RATE, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT)
+
+
+# ═══════════════════════════════════════════
+#  プロファイラ
+# ═══════════════════════════════════════════
+
+class EventProfiler:
+    """次のN件のWebhookイベントを処理するスレッドのスタックを一定間隔でサンプリングするプロファイラ
+
+    結果はflamegraph.pl・speedscopeで読めるfolded形式（"関数;関数;... 件数"）で
+    PROFILE_DIR に保存する。ファイル名には推測できないトークンを含め、URLを知っている管理者だけが取得できるようにする。
+    サンプリングするのはこのプロセスでイベントを処理中のスレッドだけ（gunicornでは受け付けたworkerのみ）。
+    """
+
+    def __init__(self, directory, interval_ms=5, max_seconds=600, keep=10):
+        self.directory = directory
+        self.interval = interval_ms / 1000
+        self.max_seconds = max_seconds
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._active = False
+        self._threads = set()
+        self._stacks = {}
+        self._remaining = 0
+        self._events = 0
+        self._samples = 0
+        self._started = 0.0
+        self._on_done = None
+        self.runs = 0
+        self.last_profile = None
+
+    @property
+    def active(self):
+        return self._active
+
+    def start(self, events, on_done):
+        """次の events 件のイベントのプロファイルを開始する。実行中ならFalse
+
+        on_done(filename, summary) は終了時（N件処理・PROFILE_MAX_SECONDS経過）に呼ばれる。
+        """
+        with self._lock:
+            if self._active:
+                return False
+            self._active = True
+            self._threads = set()
+            self._stacks = {}
+            self._remaining = events
+            self._events = 0
+            self._samples = 0
+            self._started = time.monotonic()
+            self._on_done = on_done
+        threading.Thread(target=self._sample_loop, name="event-profiler", daemon=True).start()
+        logger.info(f"Profiler started for the next {events} events")
+        return True
+
+    @contextlib.contextmanager
+    def track(self):
+        """イベント処理中のスレッドをサンプリング対象にする（開始前から処理中のイベントは数えない）"""
+        if not self._active:
+            yield
+            return
+        ident = threading.get_ident()
+        with self._lock:
+            tracked = self._active
+            if tracked:
+                self._threads.add(ident)
+        try:
+            yield
+        finally:
+            if tracked:
+                with self._lock:
+                    self._threads.discard(ident)
+                    self._events += 1
+                    self._remaining -= 1
+                    done = self._remaining <= 0
+                if done:
+                    self._finish()
+
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _sample_loop(self):
+        deadline = self._started + self.max_seconds
+        while self._active:
+            if time.monotonic() >= deadline:
+                self._finish()
+                return
+            frames = sys._current_frames()
+            with self._lock:
+                for ident in self._threads:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = self._fold(frame)
+                        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                        self._samples += 1
+            del frames
+            time.sleep(self.interval)
+
+    def _finish(self):
+        with self._lock:
+            if not self._active:
+                return
+            self._active = False
+            stacks, samples, events = self._stacks, self._samples, self._events
+            elapsed = time.monotonic() - self._started
+            on_done = self._on_done
+        filename = None
+        try:
+            filename = self._write(stacks)
+        except Exception as e:
+            logger.error(f"Failed to save profile: {e}\n{traceback.format_exc()}")
+        summary = {
+            "events": events,
+            "samples": samples,
+            "seconds": round(elapsed, 1),
+            "top": self._top_functions(stacks, samples),
+        }
+        self.runs += 1
+        self.last_profile = {"filename": filename, **summary}
+        logger.info(f"Profiler finished: {events} events, {samples} samples, saved to {filename}")
+        if on_done:
+            try:
+                on_done(filename, summary)
+            except Exception as e:
+                logger.error(f"Profiler callback failed: {e}\n{traceback.format_exc()}")
+
+    @staticmethod
+    def _top_functions(stacks, samples, limit=5):
+        """スタックの末端（その時点で実行中だった関数）ごとのサンプル割合"""
+        leaves = {}
+        for stack, n in stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + n
+        top = sorted(leaves.items(), key=lambda kv: -kv[1])[:limit]
+        return [(name, round(n / samples * 100, 1)) for name, n in top] if samples else []
+
+    def _write(self, stacks):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex}.folded"
+        with open(os.path.join(self.directory, filename), "w", encoding="utf-8") as f:
+            for stack, n in sorted(stacks.items(), key=lambda kv: -kv[1]):
+                f.write(f"{stack} {n}\n")
+        # 古いプロファイルは PROFILE_KEEP 件だけ残す
+        profiles = sorted(entry for entry in os.listdir(self.directory) if entry.startswith("profile-"))
+        for old in profiles[:-self.keep]:
+            os.remove(os.path.join(self.directory, old))
+        return filename
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "remaining_events": self._remaining if self._active else 0,
+            "interval_ms": self.interval * 1000,
+            "runs": self.runs,
+            "last_profile": self.last_profile,
+        }
+
+
+profiler = EventProfiler(PROFILE_DIR, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS, PROFILE_KEEP)
 
 
 # ═══════════════════════════════════════════
 #  X (Twitter) API連携
 # ═══════════════════════════════════════════
 
-# 起動時にX API認証情報の設定状況をログ出力
-logger.info("=== X API credentials check ===")
-logger.info(f"X_API_KEY: {'SET (' + str(len(X_API_KEY)) + ' chars)' if X_API_KEY else 'NOT SET'}")
-logger.info(f"X_API_KEY_SECRET: {'SET (' + str(len(X_API_KEY_SECRET)) + ' chars)' if X_API_KEY_SECRET else 'NOT SET'}")
-logger.info(f"X_ACCESS_TOKEN: {'SET (' + str(len(X_ACCESS_TOKEN)) + ' chars)' if X_ACCESS_TOKEN else 'NOT SET'}")
-logger.info(f"X_ACCESS_TOKEN_SECRET: {'SET (' + str(len(X_ACCESS_TOKEN_SECRET)) + ' chars)' if X_ACCESS_TOKEN_SECRET else 'NOT SET'}")
-logger.info("===============================")
+@functools.lru_cache(maxsize=None)
+def log_x_credentials():
+    """X API認証情報の設定状況をログ出力（プロセスごとに初回のみ。warm_up またはX投稿時に呼ばれる）"""
+    logger.info("=== X API credentials check ===")
+    logger.info(f"X_API_KEY: {'SET (' + str(len(X_API_KEY)) + ' chars)' if X_API_KEY else 'NOT SET'}")
+    logger.info(f"X_API_KEY_SECRET: {'SET (' + str(len(X_API_KEY_SECRET)) + ' chars)' if X_API_KEY_SECRET else 'NOT SET'}")
+    logger.info(f"X_ACCESS_TOKEN: {'SET (' + str(len(X_ACCESS_TOKEN)) + ' chars)' if X_ACCESS_TOKEN else 'NOT SET'}")
+    logger.info(f"X_ACCESS_TOKEN_SECRET: {'SET (' + str(len(X_ACCESS_TOKEN_SECRET)) + ' chars)' if X_ACCESS_TOKEN_SECRET else 'NOT SET'}")
+    logger.info("===============================")
 
 
 def get_x_client():
     """Tweepy Client (API v2) を取得"""
+    log_x_credentials()
     if not all([X_API_KEY, X_API_KEY_SECRET, X_ACCESS_TOKEN, X_ACCESS_TOKEN_SECRET]):
         missing = []
         if not X_API_KEY: missing.append("X_API_KEY")
@@ -157,6 +877,7 @@ def get_x_client():
         logger.error(f"X API credentials missing: {', '.join(missing)}")
         return None
     try:
+        import tweepy
         client = tweepy.Client(
             consumer_key=X_API_KEY,
             consumer_secret=X_API_KEY_SECRET,
@@ -170,9 +891,11 @@ def get_x_client():
         return None
 
 
+@timed_stage("x.post")
 def post_to_x(text):
     """Xにテキストを投稿する（tweepy + HTTPフォールバック）"""
     logger.info(f"post_to_x called with text length: {len(text)}")
+    log_x_credentials()
 
     if not all([X_API_KEY, X_API_KEY_SECRET, X_ACCESS_TOKEN, X_ACCESS_TOKEN_SECRET]):
         missing = []
@@ -184,8 +907,9 @@ def post_to_x(text):
         logger.error(f"X API credentials not fully set. {error_detail}")
         return False, f"X APIの認証情報が設定されていません。\n{error_detail}"
 
-    # まずtweepyで試行
-    client = get_x_client()
+    # まずtweepyで試行（tweepyは接続先が固定のため、X_API_BASE_URL を変更している場合は直接HTTPで投稿する）
+    import tweepy
+    client = get_x_client() if X_API_BASE_URL == "https://api.x.com" else None
     if client:
         try:
             logger.info("Attempting to post tweet via tweepy...")
@@ -226,7 +950,7 @@ def post_to_x(text):
             resource_owner_secret=X_ACCESS_TOKEN_SECRET,
         )
         resp = http_requests.post(
-            "https://api.x.com/2/tweets",
+            f"{X_API_BASE_URL}/2/tweets",
             json={"text": text},
             auth=auth,
             timeout=30
@@ -239,6 +963,7 @@ def post_to_x(text):
             return True, tweet_id
         else:
             error_msg = resp.text
+            record_stage_error("x.post")
             logger.error(f"Direct X API failed: {resp.status_code} {error_msg}")
             # ユーザー向けのわかりやすいエラーメッセージ
             if resp.status_code == 401:
@@ -250,20 +975,322 @@ def post_to_x(text):
             else:
                 return False, f"X APIエラー ({resp.status_code}): {error_msg[:200]}"
     except Exception as e:
+        record_stage_error("x.post")
         logger.error(f"Direct X API call failed: {e}\n{traceback.format_exc()}")
         return False, f"X投稿に失敗しました: {str(e)[:200]}"
 
 
+# ═══════════════════════════════════════════
+#  LINE Messaging APIクライアント
+# ═══════════════════════════════════════════
+
+class LineClient:
+    """keep-aliveの接続プールを共有するLINE Messaging APIクライアント
+
+    MessagingApiと同じ reply_message / push_message / broadcast を持つ。
+    push・broadcastは429・5xx・接続エラーをジッター付き指数バックオフで再試行し、
+    X-Line-Retry-Keyを付けて同じメッセージが二重に送信されないようにする。
+    replyはreply tokenが1回限りのため再試行しない。
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, configuration, connect_timeout=5, read_timeout=30, max_retries=3):
+        self.configuration = configuration
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self._api = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.latency = {
+            endpoint: metrics.histogram("zenryoku_stage_duration_seconds", stage=f"line.{endpoint}")
+            for endpoint in ("reply", "push", "broadcast")
+        }
+        self.retries = 0
+        self.errors = 0
+
+    def _get_api(self):
+        # fork後は親の接続を共有しないよう、プロセスごとにApiClientを作り直す
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._api = MessagingApi(ApiClient(self.configuration))
+                    self._pid = os.getpid()
+        return self._api
+
+    @staticmethod
+    def _backoff(attempt, error=None):
+        """再試行までの待ち秒数（Retry-Afterがあれば優先し、ジッターを加える）"""
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("Retry-After") or headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, 0.5)
+            except ValueError:
+                pass
+        return random.uniform(0, min(8.0, 0.5 * (2 ** attempt)))
+
+    def _call(self, endpoint, call, retry):
+        retry_key = str(uuid.uuid4()) if retry else None
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            started = time.perf_counter()
+            with tracer.span(f"line.{endpoint}", attempt=attempt) as span:
+                try:
+                    return call(self._get_api(), retry_key)
+                except (ApiException, urllib3.exceptions.HTTPError) as e:
+                    error = e
+                    if span:
+                        span.error = f"{type(e).__name__}: {getattr(e, 'status', None) or e}"[:200]
+                finally:
+                    self.latency[endpoint].observe((time.perf_counter() - started) * 1000)
+
+            status = getattr(error, "status", None)
+            if status == 409 and attempt > 0:
+                # 前回の試行が受理済み（同じretry keyで送信済み）
+                logger.info(f"LINE {endpoint} already accepted (retry key {retry_key})")
+                return None
+            retryable = not status or status in self.RETRY_STATUSES
+            if not retryable or attempt >= attempts - 1:
+                self.errors += 1
+                record_stage_error(f"line.{endpoint}")
+                raise error
+            delay = self._backoff(attempt, error)
+            self.retries += 1
+            logger.warning(f"LINE {endpoint} failed ({status or error}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+    def reply_message(self, reply_message_request):
+        return self._call("reply", lambda api, _key: api.reply_message(
+            reply_message_request, _request_timeout=self.timeout), retry=False)
+
+    def push_message(self, push_message_request):
+        return self._call("push", lambda api, key: api.push_message(
+            push_message_request, x_line_retry_key=key, _request_timeout=self.timeout), retry=True)
+
+    def broadcast(self, broadcast_request):
+        return self._call("broadcast", lambda api, key: api.broadcast(
+            broadcast_request, x_line_retry_key=key, _request_timeout=self.timeout), retry=True)
+
+    def stats(self):
+        return {
+            "pool_size": self.configuration.connection_pool_maxsize,
+            "retries": self.retries,
+            "errors": self.errors,
+            "latency": {endpoint: histogram.snapshot() for endpoint, histogram in self.latency.items()},
+        }
+
+
+line_client = LineClient(
+    configuration,
+    connect_timeout=LINE_CONNECT_TIMEOUT,
+    read_timeout=LINE_READ_TIMEOUT,
+    max_retries=LINE_MAX_RETRIES,
+)
+
+
+# ═══════════════════════════════════════════
+#  Notion APIクライアント
+# ═══════════════════════════════════════════
+
+class NotionClient:
+    """keep-aliveの接続プールを共有するNotion APIクライアント
+
+    429（Retry-Afterを尊重）・5xx・接続エラーはジッター付き指数バックオフで再試行する。
+    """
+
+    BASE_URL = "https://api.notion.com/v1"
+    NOTION_VERSION = "2022-06-28"
+
+    def __init__(self, api_key, pool_size=10, connect_timeout=5, read_timeout=30, max_retries=3, base_url=None):
+        self.api_key = api_key
+        self.base_url = base_url or self.BASE_URL
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.cold_count = 0
+        self.cold_ms = 0.0
+        self.warm_count = 0
+        self.warm_ms = 0.0
+
+    def _get_session(self):
+        # fork後は親の接続を共有しないよう、プロセスごとにSessionを作り直す
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = http_requests.Session()
+                    adapter = http_requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({
+                        "Authorization": f"Bearer {self.api_key}",
+                        "Content-Type": "application/json",
+                        "Notion-Version": self.NOTION_VERSION,
+                    })
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    @staticmethod
+    def _opened_connections(adapter):
+        pools = adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()) if key in pools)
+
+    def _backoff(self, attempt, resp=None):
+        """再試行までの待ち秒数（Retry-Afterがあれば優先し、ジッターを加える）"""
+        if resp is not None and resp.headers.get("Retry-After"):
+            try:
+                return float(resp.headers["Retry-After"]) + random.uniform(0, 0.5)
+            except ValueError:
+                pass
+        return random.uniform(0, min(8.0, 0.5 * (2 ** attempt)))
+
+    @staticmethod
+    def _is_idempotent(method, path):
+        """同じリクエストを繰り返しても結果が変わらない呼び出し（取得・DBクエリ・固定値へのPATCH）"""
+        return method in ("GET", "PATCH", "DELETE") or (method == "POST" and path.endswith("/query"))
+
+    @staticmethod
+    def _not_sent(error):
+        """接続できずにリクエストがNotionへ届いていないことが確実な失敗か"""
+        if isinstance(error, http_requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def request(self, method, path, payload=None):
+        """APIを呼び出してJSONを返す。再試行しても失敗した場合は例外を送出
+
+        ページ作成などの冪等でない呼び出しは、Notion側で処理済みかもしれない失敗（読み取りタイムアウト・5xx）では
+        再試行しない（二重に作成されるため）。429と接続できなかった場合だけ再試行する。
+        """
+        with tracer.span("notion.request", method=method, path=path.split("/")[0]):
+            return self._request(method, path, payload)
+
+    def _request(self, method, path, payload):
+        idempotent = self._is_idempotent(method, path)
+        session = self._get_session()
+        url = f"{self.base_url}/{path}"
+        adapter = session.get_adapter(url)
+        for attempt in range(self.max_retries + 1):
+            connections_before = self._opened_connections(adapter)
+            started = time.perf_counter()
+            self.requests += 1
+            try:
+                resp = session.request(method, url, json=payload, timeout=self.timeout)
+            except (http_requests.ConnectionError, http_requests.Timeout) as e:
+                if attempt >= self.max_retries or not (idempotent or self._not_sent(e)):
+                    self.errors += 1
+                    raise
+                delay = self._backoff(attempt)
+                self.retries += 1
+                logger.warning(f"Notion {method} {path} failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            # この呼び出しで新しいTCP(+TLS)接続を張った場合をcoldとして計測する
+            cold = self._opened_connections(adapter) > connections_before
+            if cold:
+                self.cold_count += 1
+                self.cold_ms += elapsed_ms
+            else:
+                self.warm_count += 1
+                self.warm_ms += elapsed_ms
+            logger.info(f"Notion {method} {path} -> {resp.status_code} in {elapsed_ms:.0f}ms ({'cold' if cold else 'warm'})")
+
+            retryable = resp.status_code == 429 or (resp.status_code >= 500 and idempotent)
+            if retryable and attempt < self.max_retries:
+                delay = self._backoff(attempt, resp)
+                self.retries += 1
+                logger.warning(f"Notion {method} {path} returned {resp.status_code}, retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            if resp.status_code >= 400:
+                self.errors += 1
+            tracer.annotate(status=resp.status_code, attempts=attempt + 1, cold=cold)
+            resp.raise_for_status()
+            return resp.json()
+
+    def post(self, path, payload):
+        return self.request("POST", path, payload)
+
+    def patch(self, path, payload):
+        return self.request("PATCH", path, payload)
+
+    def stats(self):
+        return {
+            "pool_size": self.pool_size,
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "cold_requests": self.cold_count,
+            "cold_avg_ms": round(self.cold_ms / self.cold_count, 1) if self.cold_count else None,
+            "warm_requests": self.warm_count,
+            "warm_avg_ms": round(self.warm_ms / self.warm_count, 1) if self.warm_count else None,
+        }
+
+
+notion_client = NotionClient(
+    NOTION_API_KEY,
+    pool_size=NOTION_POOL_SIZE,
+    connect_timeout=NOTION_CONNECT_TIMEOUT,
+    read_timeout=NOTION_READ_TIMEOUT,
+    max_retries=NOTION_MAX_RETRIES,
+    base_url=NOTION_API_BASE_URL,
+)
+
+
 # ═══════════════════════════════════════════
 #  Notion API連携 - シフト管理
 # ═══════════════════════════════════════════
 
-def fetch_shift_data_from_notion(year, month):
-    """NotionのシフトDBから指定月のシフトデータを取得"""
-    if not NOTION_API_KEY:
-        logger.error("NOTION_API_KEY is not set")
-        return []
+def parse_shift_page(page):
+    """シフトDBのページ1件をシフトdictに変換（日付のないページはNone）"""
+    props = page.get("properties", {})
+
+    # タイトル（セラピスト名）
+    title_prop = props.get("タイトル", {})
+    title_arr = title_prop.get("title", [])
+    therapist_name = title_arr[0]["plain_text"] if title_arr else ""
+
+    # 日付
+    date_prop = props.get("日付", {})
+    date_obj = date_prop.get("date", {})
+    if not date_obj:
+        return None
+    start_date = date_obj.get("start", "")
+    end_date = date_obj.get("end", "")
+
+    # 条件（出勤時間帯）
+    condition_prop = props.get("条件", {})
+    rich_text = condition_prop.get("rich_text", [])
+    condition = "".join(t.get("plain_text", "") for t in rich_text) if rich_text else ""
 
+    # ルーム
+    room_prop = props.get("ルーム", {})
+    room_select = room_prop.get("select", {})
+    room = room_select.get("name", "") if room_select else ""
+
+    return {
+        "therapist": therapist_name,
+        "start_date": start_date,
+        "end_date": end_date,
+        "condition": condition,
+        "room": room,
+    }
+
+
+@timed_stage("notion.shift_query")
+def load_shift_data_from_notion(year, month):
+    """NotionのシフトDBから指定月のシフトデータを全ページ取得（失敗時は例外を送出）"""
     # 月の初日と翌月の初日を計算
     first_day = date(year, month, 1)
     if month == 12:
@@ -271,13 +1298,6 @@ def fetch_shift_data_from_notion(year, month):
     else:
         next_month_first = date(year, month + 1, 1)
 
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-
     # 日付フィルター: 月の範囲内のシフトを取得
     payload = {
         "filter": {
@@ -307,125 +1327,445 @@ def fetch_shift_data_from_notion(year, month):
         if start_cursor:
             payload["start_cursor"] = start_cursor
 
+        data = notion_client.post(f"databases/{NOTION_DATABASE_ID}/query", payload)
+        for page in data.get("results", []):
+            shift = parse_shift_page(page)
+            if shift:
+                all_results.append(shift)
+
+        has_more = data.get("has_more", False)
+        start_cursor = data.get("next_cursor")
+
+    return all_results
+
+
+class ShiftMirror:
+    """NotionシフトDBのローカルSQLiteミラー
+
+    バックグラウンドで last_edited_time がウォーターマーク以降のページだけを取り込み、
+    アーカイブ・削除されたページは定期的な全件照合で取り除く。
+    複数プロセスで起動した場合、ファイルロックを取れた1プロセスだけが同期し、
+    他のプロセスはミラーの更新を検知して自分のシフトキャッシュを破棄する。
+    同期担当でないプロセスも毎回ロックの取得を試みるため、graceful reloadで古い同期担当が終了しても
+    新しいworkerのどれかが同期を引き継ぐ。
+    同期担当でないプロセスからの即時同期の依頼はmetaテーブル経由で同期担当に渡す。
+    """
+
+    def __init__(self, path, database_id, sync_interval, full_sync_interval):
+        self.path = path
+        self.database_id = database_id
+        self.sync_interval = sync_interval
+        self.full_sync_interval = full_sync_interval
+        self._local = threading.local()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._seen_version = None
+        self._lock_file = None
+        self.is_syncer = False
+        self.syncs = 0
+        self.full_syncs = 0
+        self.errors = 0
+        self.last_sync_ms = None
+        self.last_changed = 0
+
+    def _conn(self):
+        return thread_sqlite_connection(self._local, self.path)
+
+    def _init_db(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS shifts (
+                page_id TEXT PRIMARY KEY,
+                therapist TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT,
+                condition TEXT NOT NULL,
+                room TEXT NOT NULL,
+                start_day TEXT NOT NULL,
+                last_edited_time TEXT NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS shifts_start_day ON shifts (start_day)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _get_meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def start(self):
+        """このプロセスで同期スレッドを起動する（起動済みなら何もしない）"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._init_db()
+            self.is_syncer = self._acquire_sync_lock()
+            threading.Thread(target=self._run, name="shift-mirror", daemon=True).start()
+            logger.info(f"Shift mirror started: path={self.path}, syncer={self.is_syncer}")
+
+    def _acquire_sync_lock(self):
         try:
-            resp = http_requests.post(url, headers=headers, json=payload, timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
+            import fcntl
+        except ImportError:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _run(self):
+        while True:
+            try:
+                if not self.is_syncer and self._acquire_sync_lock():
+                    self.is_syncer = True
+                    logger.info("Shift mirror: took over syncing (previous syncer exited)")
+                if self.is_syncer:
+                    last_full = float(self._get_meta("last_full_sync_at", "0"))
+                    with self._sync_lock:
+                        self.sync(full=time.time() - last_full >= self.full_sync_interval)
+                self._check_version()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Shift mirror sync failed: {e}\n{traceback.format_exc()}")
+            self._wait()
+
+    def _wait(self):
+        """次の同期まで待つ（同期依頼があれば早めに戻り、ミラーの更新は1秒ごとに反映する）"""
+        deadline = time.monotonic() + self.sync_interval
+        while time.monotonic() < deadline:
+            time.sleep(1)
+            try:
+                if self.is_syncer and self._sync_requested():
+                    return
+                self._check_version()
+            except Exception as e:
+                logger.warning(f"Shift mirror check failed: {e}")
+
+    def _check_version(self):
+        """ミラーが更新されていればこのプロセスのシフトキャッシュを破棄する"""
+        version = self._get_meta("version")
+        if version != self._seen_version:
+            if self._seen_version is not None:
+                shift_cache.invalidate()
+            self._seen_version = version
+
+    def _sync_requested(self):
+        requested_at = float(self._get_meta("sync_requested_at", "0"))
+        return requested_at > float(self._get_meta("last_sync_at", "0"))
+
+    def request_sync(self):
+        """すぐに差分同期する（同期担当ならこの場で同期して変更件数を返し、それ以外は同期担当に依頼してNoneを返す）"""
+        self.start()
+        if self.is_syncer:
+            with self._sync_lock:
+                changed = self.sync()
+            self._check_version()
+            return changed
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('sync_requested_at', ?)", (str(time.time()),))
+        return None
 
+    def sync(self, full=False):
+        """Notionから変更分（fullなら全件）を取り込み、変更件数を返す"""
+        started = time.perf_counter()
+        sync_started_at = time.time()
+        watermark = None if full else self._get_meta("watermark")
+        payload = {
+            "sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}],
+            "page_size": 100,
+        }
+        if watermark:
+            # last_edited_timeは分単位に丸められるため、境界のページは重複して取り込む（upsertなので無害）
+            payload["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": watermark}}
+
+        upserts = []
+        deletes = []
+        seen_ids = set()
+        new_watermark = watermark
+        has_more = True
+        while has_more:
+            data = notion_client.post(f"databases/{self.database_id}/query", payload)
             for page in data.get("results", []):
-                props = page.get("properties", {})
+                page_id = page["id"]
+                seen_ids.add(page_id)
+                edited = page.get("last_edited_time", "")
+                new_watermark = max(new_watermark or "", edited)
+                shift = None if page.get("archived") or page.get("in_trash") else parse_shift_page(page)
+                start_d = parse_date_safe(shift["start_date"]) if shift else None
+                if not start_d:
+                    deletes.append(page_id)
+                    continue
+                upserts.append((page_id, shift["therapist"], shift["start_date"], shift["end_date"] or "",
+                                shift["condition"], shift["room"], start_d.isoformat(), edited))
+            has_more = data.get("has_more", False)
+            payload["start_cursor"] = data.get("next_cursor")
+
+        conn = self._conn()
+        with conn:
+            before = conn.total_changes
+            conn.executemany("""INSERT INTO shifts VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(page_id) DO UPDATE SET
+                    therapist = excluded.therapist, start_date = excluded.start_date,
+                    end_date = excluded.end_date, condition = excluded.condition, room = excluded.room,
+                    start_day = excluded.start_day, last_edited_time = excluded.last_edited_time
+                WHERE excluded.last_edited_time != shifts.last_edited_time""", upserts)
+            conn.executemany("DELETE FROM shifts WHERE page_id = ?", [(p,) for p in deletes])
+            if full:
+                # クエリ結果に現れなかったページはNotion側で削除・アーカイブされている
+                existing = {row["page_id"] for row in conn.execute("SELECT page_id FROM shifts")}
+                conn.executemany("DELETE FROM shifts WHERE page_id = ?", [(p,) for p in existing - seen_ids])
+            changed = conn.total_changes - before
+            meta = {"last_sync_at": str(sync_started_at)}
+            if new_watermark:
+                meta["watermark"] = new_watermark
+            if full:
+                meta["last_full_sync_at"] = str(sync_started_at)
+            if changed:
+                meta["version"] = uuid.uuid4().hex
+            conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", list(meta.items()))
+
+        self.syncs += 1
+        if full:
+            self.full_syncs += 1
+        self.last_changed = changed
+        self.last_sync_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Shift mirror {'full' if full else 'incremental'} sync: "
+                    f"{len(upserts)} pages, {changed} rows changed in {self.last_sync_ms:.0f}ms")
+        return changed
+
+    def ready(self):
+        """全件同期が1回以上完了していればTrue"""
+        return self._pid == os.getpid() and self._get_meta("last_full_sync_at") is not None
+
+    def query_month(self, year, month):
+        """指定月のシフトをミラーから取得（load_shift_data_from_notionと同じ形式）"""
+        first_day = date(year, month, 1)
+        last_day = date(year, month, calendar.monthrange(year, month)[1])
+        rows = self._conn().execute(
+            "SELECT therapist, start_date, end_date, condition, room FROM shifts "
+            "WHERE start_day BETWEEN ? AND ? ORDER BY start_date",
+            (first_day.isoformat(), last_day.isoformat()))
+        return [{
+            "therapist": row["therapist"],
+            "start_date": row["start_date"],
+            "end_date": row["end_date"],
+            "condition": row["condition"],
+            "room": row["room"],
+        } for row in rows]
+
+    def stats(self):
+        if self._pid != os.getpid():
+            return {"enabled": True, "started": False}
+        last_sync_at = float(self._get_meta("last_sync_at", "0")) or None
+        lag = round(time.time() - last_sync_at, 1) if last_sync_at else None
+        return {
+            "enabled": True,
+            "started": True,
+            "syncer": self.is_syncer,
+            "ready": self.ready(),
+            "rows": self._conn().execute("SELECT COUNT(*) FROM shifts").fetchone()[0],
+            "watermark": self._get_meta("watermark"),
+            "sync_interval": self.sync_interval,
+            "last_sync_age_seconds": lag,
+            # 同期間隔の3倍以上同期されていなければ、同期担当が止まっている
+            "stale": lag is None or lag > self.sync_interval * 3,
+            "last_sync_ms": round(self.last_sync_ms, 1) if self.last_sync_ms is not None else None,
+            "last_changed": self.last_changed,
+            "syncs": self.syncs,
+            "full_syncs": self.full_syncs,
+            "errors": self.errors,
+        }
 
-                # タイトル（セラピスト名）
-                title_prop = props.get("タイトル", {})
-                title_arr = title_prop.get("title", [])
-                therapist_name = title_arr[0]["plain_text"] if title_arr else ""
 
-                # 日付
-                date_prop = props.get("日付", {})
-                date_obj = date_prop.get("date", {})
-                if not date_obj:
-                    continue
-                start_date = date_obj.get("start", "")
-                end_date = date_obj.get("end", "")
-
-                # 条件（出勤時間帯）
-                condition_prop = props.get("条件", {})
-                rich_text = condition_prop.get("rich_text", [])
-                condition = "".join(t.get("plain_text", "") for t in rich_text) if rich_text else ""
-
-                # ルーム
-                room_prop = props.get("ルーム", {})
-                room_select = room_prop.get("select", {})
-                room = room_select.get("name", "") if room_select else ""
-
-                all_results.append({
-                    "therapist": therapist_name,
-                    "start_date": start_date,
-                    "end_date": end_date,
-                    "condition": condition,
-                    "room": room,
-                })
+shift_mirror = ShiftMirror(
+    SHIFT_MIRROR_PATH, NOTION_DATABASE_ID, SHIFT_SYNC_INTERVAL, SHIFT_FULL_SYNC_INTERVAL
+) if SHIFT_MIRROR_PATH and NOTION_API_KEY else None
 
-            has_more = data.get("has_more", False)
-            start_cursor = data.get("next_cursor")
 
-        except Exception as e:
-            logger.error(f"Notion API error: {e}\n{traceback.format_exc()}")
-            break
+def load_shift_data(year, month):
+    """指定月のシフトデータを取得（ミラーが同期済みならローカルから、未同期ならNotionから）"""
+    if shift_mirror and shift_mirror.ready():
+        return shift_mirror.query_month(year, month)
+    return load_shift_data_from_notion(year, month)
+
+
+def build_shift_date_index(shift_data):
+    """シフトデータを日付順のインデックスに展開する
+
+    複数日にまたがるシフトは1日ずつに展開し、bisectで範囲を切り出せるよう
+    日付の昇順リスト dates と、それに対応する出勤情報 rows を返す。
+    """
+    entries = []
+    for shift in shift_data:
+        start_d = parse_date_safe(shift["start_date"])
+        if not start_d:
+            continue
+        end_d = parse_date_safe(shift["end_date"]) or start_d
+        current = start_d
+        while current <= end_d:
+            entries.append((current, shift["start_date"], {
+                "name": shift["therapist"],
+                "date": current.isoformat(),
+                "condition": shift["condition"],
+                "room": shift["room"],
+            }))
+            current += timedelta(days=1)
+    entries.sort(key=lambda e: (e[0], e[1]))
+    return [e[0] for e in entries], [e[2] for e in entries]
 
-    return all_results
+
+class ShiftCache:
+    """(year, month) 単位のシフトデータキャッシュ（TTL + stale-while-revalidate）
+
+    TTL内はそのまま返し、TTL切れでも max_stale 以内なら古いデータを即座に返しつつ
+    バックグラウンドで再取得する。それ以上古い場合やキャッシュがない場合は同期的に取得する。
+    """
+
+    def __init__(self, loader, ttl, max_stale):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries = {}
+        self._key_locks = {}
+        self._refreshing = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    def get(self, year, month):
+        return self._get_entry((year, month))["data"]
+
+    def get_index(self, year, month):
+        """指定月の日付インデックス (dates, rows) を返す（build_shift_date_index参照）"""
+        return self._get_entry((year, month))["index"]
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            age = time.monotonic() - entry["loaded_at"]
+            if age < self.ttl:
+                self.hits += 1
+                return entry
+            if age < self.ttl + self.max_stale:
+                self.stale_hits += 1
+                self._refresh_async(key)
+                return entry
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # 同じ月を待っていた他スレッドが取得済みならそれを使う（single-flight）
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry["loaded_at"] < self.ttl:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return self._load(key)
+
+    def _load(self, key):
+        generation = self._generation
+        data = self.loader(*key)
+        entry = {"data": data, "index": build_shift_date_index(data), "loaded_at": time.monotonic()}
+        with self._lock:
+            # 取得中に無効化された場合は古い結果で上書きしない
+            if generation == self._generation:
+                self._entries[key] = entry
+        return entry
+
+    def _refresh_async(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._load(key)
+                self.refreshes += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Shift cache refresh failed for {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name=f"shift-refresh-{key[0]}-{key[1]}", daemon=True).start()
+
+    def invalidate(self, year=None, month=None):
+        """指定月（省略時は全件）のキャッシュを破棄する"""
+        with self._lock:
+            self._generation += 1
+            if year is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((year, month), None)
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "ttl": self.ttl,
+            "max_stale": self.max_stale,
+            "months": sorted(f"{y}-{m:02d}" for y, m in self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 3) if lookups else None,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "invalidations": self.invalidations,
+        }
+
+
+shift_cache = ShiftCache(load_shift_data, SHIFT_CACHE_TTL, SHIFT_CACHE_MAX_STALE)
+
+
+def fetch_shift_data_from_notion(year, month):
+    """NotionのシフトDBから指定月のシフトデータを取得（キャッシュ経由）"""
+    if not NOTION_API_KEY:
+        logger.error("NOTION_API_KEY is not set")
+        return []
+
+    try:
+        return shift_cache.get(year, month)
+    except Exception as e:
+        shift_cache.errors += 1
+        logger.error(f"Notion API error: {e}\n{traceback.format_exc()}")
+        return []
 
 
 def fetch_upcoming_shifts(days=7):
-    """今日から指定日数分の出勤情報を取得"""
+    """今日から指定日数分の出勤情報を取得（月単位のシフトキャッシュの日付インデックスから切り出す）"""
     if not NOTION_API_KEY:
         return []
 
     today = date.today()
     end_date = today + timedelta(days=days-1)
 
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-
-    payload = {
-        "filter": {
-            "and": [
-                {
-                    "property": "日付",
-                    "date": {
-                        "on_or_after": today.isoformat()
-                    }
-                },
-                {
-                    "property": "日付",
-                    "date": {
-                        "on_or_before": end_date.isoformat()
-                    }
-                }
-            ]
-        },
-        "sorts": [{"property": "日付", "direction": "ascending"}],
-    }
-
     shifts = []
-    try:
-        resp = http_requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+    # 月のインデックスはシフトの開始日の月にまとまっているため、前月に始まり今日も続いているシフトを拾うよう前月から読む
+    year, month = (today.year - 1, 12) if today.month == 1 else (today.year, today.month - 1)
+    while (year, month) <= (end_date.year, end_date.month):
+        try:
+            dates, rows = shift_cache.get_index(year, month)
+            shifts.extend(rows[bisect_left(dates, today):bisect_right(dates, end_date)])
+        except Exception as e:
+            logger.error(f"Failed to fetch upcoming shifts for {year}-{month:02d}: {e}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
 
-        for page in data.get("results", []):
-            props = page.get("properties", {})
-            
-            title_prop = props.get("タイトル", {})
-            title_arr = title_prop.get("title", [])
-            name = title_arr[0]["plain_text"] if title_arr else ""
-
-            date_prop = props.get("日付", {})
-            date_obj = date_prop.get("date", {})
-            if not date_obj: continue
-            start_date = date_obj.get("start", "")
-
-            condition_prop = props.get("条件", {})
-            rich_text = condition_prop.get("rich_text", [])
-            condition = "".join(t.get("plain_text", "") for t in rich_text) if rich_text else ""
-
-            room_prop = props.get("ルーム", {})
-            room_select = room_prop.get("select", {})
-            room = room_select.get("name", "") if room_select else ""
-
-            shifts.append({
-                "name": name,
-                "date": start_date,
-                "condition": condition,
-                "room": room
-            })
-    except Exception as e:
-        logger.error(f"Failed to fetch upcoming shifts: {e}")
-    
+    # 前月に始まったシフトの今月分は前月のインデックスから取り出されるため、最後に日付順へ揃える
+    shifts.sort(key=lambda s: s["date"])
     return shifts
 
 
@@ -433,19 +1773,13 @@ def fetch_upcoming_shifts(days=7):
 #  Notion API連携 - ニュース管理
 # ═══════════════════════════════════════════
 
+@timed_stage("notion.save_news")
 def save_news_to_notion(title, body, category):
     """ニュースをNotionデータベースに保存"""
     if not NOTION_API_KEY:
         logger.error("NOTION_API_KEY is not set")
         return None
 
-    url = "https://api.notion.com/v1/pages"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-
     now = datetime.now()
     payload = {
         "parent": {"database_id": NOTION_NEWS_DATABASE_ID},
@@ -469,38 +1803,29 @@ def save_news_to_notion(title, body, category):
     }
 
     try:
-        resp = http_requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+        data = notion_client.post("pages", payload)
         logger.info(f"News saved to Notion: {data.get('id')}")
         return data.get("id")
     except Exception as e:
+        record_stage_error("notion.save_news")
         logger.error(f"Failed to save news to Notion: {e}\n{traceback.format_exc()}")
         return None
 
 
+@timed_stage("notion.fetch_news")
 def fetch_news_from_notion(limit=10):
     """Notionからニュース一覧を取得"""
     if not NOTION_API_KEY:
         logger.error("NOTION_API_KEY is not set")
         return []
 
-    url = f"https://api.notion.com/v1/databases/{NOTION_NEWS_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-
     payload = {
         "sorts": [{"property": "作成日時", "direction": "descending"}],
         "page_size": limit,
     }
 
     try:
-        resp = http_requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+        data = notion_client.post(f"databases/{NOTION_NEWS_DATABASE_ID}/query", payload)
 
         news_list = []
         for page in data.get("results", []):
@@ -542,22 +1867,17 @@ def fetch_news_from_notion(limit=10):
 
         return news_list
     except Exception as e:
+        record_stage_error("notion.fetch_news")
         logger.error(f"Failed to fetch news from Notion: {e}\n{traceback.format_exc()}")
         return []
 
 
+@timed_stage("notion.mark_delivered")
 def mark_news_as_delivered(page_id):
     if not NOTION_API_KEY:
         logger.error("NOTION_API_KEY is not set")
         return False
 
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-
     now = datetime.now()
     payload = {
         "properties": {
@@ -567,11 +1887,11 @@ def mark_news_as_delivered(page_id):
     }
 
     try:
-        resp = http_requests.patch(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
+        notion_client.patch(f"pages/{page_id}", payload)
         logger.info(f"News marked as delivered: {page_id}")
         return True
     except Exception as e:
+        record_stage_error("notion.mark_delivered")
         logger.error(f"Failed to mark news as delivered: {e}\n{traceback.format_exc()}")
         return False
 
@@ -614,183 +1934,730 @@ def parse_shift_to_calendar(shift_data, year, month):
     return cal_data
 
 
-def generate_calendar_image(year, month, cal_data):
-    """Pillowでカレンダー画像を生成（ダークテーマ）"""
+class CalendarRenderPool:
+    """カレンダー描画をプロセスプールで実行し、GILを握るPillowの処理をWebhookスレッドから切り離す
 
-    # フォント設定（複数パスを試行）
-    font_bold_path = None
-    font_reg_path = None
-    font_candidates_bold = [
-        "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
-        "/usr/share/fonts/truetype/noto/NotoSansCJK-Bold.ttc",
-        "/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc",
-        "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Bold.ttc",
-        "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-    ]
-    font_candidates_reg = [
-        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-        "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-        "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
-        "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
-        "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-    ]
-    for p in font_candidates_bold:
-        if os.path.exists(p):
-            font_bold_path = p
-            break
-    for p in font_candidates_reg:
-        if os.path.exists(p):
-            font_reg_path = p
-            break
+    プールが無効・タイムアウト・ワーカー異常終了の場合はリクエストスレッドで同期的に描画する。
+    タイムアウトした描画が実行中なら、ワーカーを止めてプールを作り直してから同期描画する。
+    """
+
+    def __init__(self, processes, timeout):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.pool_renders = 0
+        self.pool_ms = 0.0
+        self.sync_renders = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def start(self):
+        """プールを起動し、全ワーカーにフォントを読み込ませておく（起動済みなら何もしない）"""
+        if not self.processes or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # 多数のスレッドを抱えたプロセスからforkしないよう、spawnで起動する
+            # （ワーカーはcalendar_renderだけをimportし、app.pyの初期化やWARM_UPは走らない）
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_render_worker,
+            )
+            self._pid = os.getpid()
+            for _ in range(self.processes):
+                self._pool.submit(time.sleep, 0)
+            logger.info(f"Calendar render pool started: processes={self.processes}")
+
+    def _reset(self, pool, terminate=False):
+        """プールを破棄し、次のrenderで作り直す（他のスレッドが既に作り直していれば何もしない）
+
+        terminate=True なら実行中の描画ごとワーカープロセスを止める（shutdownは実行中のタスクを止めないため）。
+        """
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self._pid = None
+        if terminate:
+            for process in list((getattr(pool, "_processes", None) or {}).values()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, *args):
+        """render_calendar_imagesをプール（無効・失敗時は同期）で実行し (原寸画像, プレビュー画像) を返す"""
+        started = time.perf_counter()
+        original, preview, timings = self._render(*args)
+        # 工程は順に実行されるため、描画開始から順に並べてスパンにする（プールへの受け渡し時間は末尾に寄る）
+        for stage, elapsed_ms in timings.items():
+            metrics.observe("zenryoku_stage_duration_seconds", elapsed_ms, stage=stage)
+            tracer.record(stage, started, elapsed_ms)
+            started += elapsed_ms / 1000
+        return original, preview
+
+    def _render(self, *args):
+        if self.processes:
+            self.start()
+            pool = self._pool
+            started = time.perf_counter()
+            future = pool.submit(render_calendar_images, *args)
+            try:
+                data = future.result(timeout=self.timeout)
+                self.pool_renders += 1
+                self.pool_ms += (time.perf_counter() - started) * 1000
+                return data
+            except FuturesTimeoutError:
+                self.timeouts += 1
+                if not future.cancel():
+                    # 実行中の描画はcancelで止まらないため、同じ画像を二重に描画しないようワーカーごと止めて作り直す
+                    self._reset(pool, terminate=True)
+                logger.warning(f"Calendar render pool timed out after {self.timeout}s, rendering inline")
+            except BrokenProcessPool as e:
+                self.failures += 1
+                logger.error(f"Calendar render pool broken: {e}, restarting and rendering inline")
+                self._reset(pool)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Calendar render in pool failed: {e}, rendering inline")
+        self.sync_renders += 1
+        return render_calendar_images(*args)
+
+    def shutdown(self):
+        if self._pool and self._pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "processes": self.processes,
+            "timeout": self.timeout,
+            "pool_renders": self.pool_renders,
+            "pool_avg_ms": round(self.pool_ms / self.pool_renders, 1) if self.pool_renders else None,
+            "sync_renders": self.sync_renders,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+        }
+
+
+calendar_renderer = CalendarRenderPool(CALENDAR_RENDER_PROCESSES, CALENDAR_RENDER_TIMEOUT)
+atexit.register(calendar_renderer.shutdown)
+
+
+class ImageCache:
+    """配信する画像のバイト列とETagを保持する、合計バイト数で上限を設けたLRU"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0
+        self.bytes_served = 0
+
+    def get(self, filename):
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(filename)
+            self.hits += 1
+            return entry
+
+    def put(self, filename, data):
+        """画像を登録して (data, etag) を返す（上限を超える場合は登録せずに返す）"""
+        entry = (data, hashlib.blake2b(data, digest_size=16).hexdigest())
+        if len(data) > self.max_bytes:
+            return entry
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old:
+                self._size -= len(old[0])
+            self._entries[filename] = entry
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+        return entry
+
+    def discard(self, filename):
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old:
+                self._size -= len(old[0])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "max_bytes": self.max_bytes,
+            "bytes": self._size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "not_modified": self.not_modified,
+            "bytes_served": self.bytes_served,
+        }
+
+
+image_cache = ImageCache(IMAGE_CACHE_BYTES)
+
+
+class CalendarImageStore:
+    """カレンダー画像をコンテンツのハッシュで保存するストア
+
+    (year, month, cal_data, today, theme) が同じなら既存のファイルとURLを再利用し、
+    Pillowでの描画・PNGエンコード・ディスク書き込みを省く。
+    画像は他プロセスのImageJanitorにも削除されるため、既存かどうかは毎回ディスクで確認する。
+    """
 
+    def __init__(self, directory):
+        self.directory = directory
+        self._render_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.renders = 0
+        self.original_bytes = 0
+        self.preview_bytes = 0
+
+    @staticmethod
+    def content_key(year, month, cal_data, today, theme, fmt, preview_width):
+        # 当日ハイライトは表示月に今日が含まれる場合だけ画像に影響する
+        today_key = today.isoformat() if (today.year, today.month) == (year, month) else None
+        material = json.dumps([year, month, cal_data, today_key, theme, THERAPIST_COLORS, CALENDAR_THEMES[theme],
+                               fmt, preview_width], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get_or_render(self, year, month, cal_data, today=None, theme=CALENDAR_THEME):
+        """カレンダー画像の (原寸, プレビュー) ファイル名を返す（未生成なら描画して保存する）"""
+        today = today or date.today()
+        fmt = CALENDAR_IMAGE_FORMAT
+        digest = self.content_key(year, month, cal_data, today, theme, fmt, CALENDAR_PREVIEW_WIDTH)
+        base = f"schedule_{year}_{month:02d}_{digest[:16]}"
+        filename = f"{base}.{CALENDAR_IMAGE_EXTENSIONS[fmt]}"
+        preview_filename = f"{base}_preview.jpg"
+        if self._exists(filename, preview_filename):
+            self.hits += 1
+            tracer.annotate(calendar_cache="hit")
+            return filename, preview_filename
+
+        tracer.annotate(calendar_cache="miss")
+        with self._lock:
+            render_lock = self._render_locks.setdefault(filename, threading.Lock())
+        with render_lock:
+            # 同じ画像を待っていた他スレッドが保存済みならそれを使う
+            if self._exists(filename, preview_filename):
+                self.hits += 1
+                return filename, preview_filename
+            original, preview = calendar_renderer.render(
+                year, month, cal_data, today, theme, fmt, CALENDAR_PREVIEW_WIDTH)
+            self._write(preview_filename, preview)
+            self._write(filename, original)
+            self.renders += 1
+            self.original_bytes += len(original)
+            self.preview_bytes += len(preview)
+        with self._lock:
+            self._render_locks.pop(filename, None)
+        logger.info(f"Calendar image rendered: {filename} ({fmt} {len(original)} bytes, preview {len(preview)} bytes)")
+        return filename, preview_filename
+
+    def _exists(self, *filenames):
+        return all(os.path.exists(os.path.join(self.directory, f)) for f in filenames)
+
+    def _write(self, filename, data):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, filename)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        # 送信直後にLINEのサーバーが取得しに来るため、配信キャッシュにも載せておく
+        image_cache.put(filename, data)
+
+    def stats(self):
+        total = self.hits + self.renders
+        return {
+            "hits": self.hits,
+            "renders": self.renders,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+            "format": CALENDAR_IMAGE_FORMAT,
+            "original_bytes": self.original_bytes,
+            "preview_bytes": self.preview_bytes,
+            "avg_original_bytes": round(self.original_bytes / self.renders) if self.renders else None,
+            "avg_preview_bytes": round(self.preview_bytes / self.renders) if self.renders else None,
+        }
+
+
+calendar_store = CalendarImageStore(UPLOAD_DIR)
+
+
+class ImageJanitor:
+    """static/images の容量・経過時間を管理するバックグラウンドの掃除係
+
+    最終利用（送信・配信）から IMAGE_MAX_AGE_HOURS を過ぎた画像を削除し、合計が
+    IMAGE_STORE_MAX_BYTES を超える場合は最終アクセスの古い順に削除する。
+    送信時にmtimeを更新し、mtimeが IMAGE_PROTECT_HOURS 以内の画像は削除しない。
+    配信時のアクセス時刻はメモリに記録し、掃除の前にatimeとして書き戻す（複数プロセスで共有するため）。
+    """
+
+    def __init__(self, directory, max_bytes, max_age, protect_window, interval):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.protect_window = protect_window
+        self.interval = interval
+        self._accessed = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.deleted_files = 0
+        self.reclaimed_bytes = 0
+        self.last_run = None
+        self.dir_bytes = 0
+        self.dir_files = 0
+
+    def touch(self, filename):
+        """配信時に呼ぶ（最終アクセス時刻の記録）"""
+        self._accessed[filename] = time.time()
+
+    def mark_sent(self, *filenames):
+        """メッセージで送信する画像のmtimeを現在時刻にして保護期間に入れ、見つからなかったファイル名のリストを返す"""
+        missing = []
+        for filename in filenames:
+            try:
+                os.utime(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                missing.append(filename)
+        return missing
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="image-janitor", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Image janitor failed: {e}\n{traceback.format_exc()}")
+
+    def _flush_access_times(self):
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        for filename, accessed_at in accessed.items():
+            path = os.path.join(self.directory, filename)
+            try:
+                st = os.stat(path)
+                if accessed_at > st.st_atime:
+                    os.utime(path, (accessed_at, st.st_mtime))
+            except FileNotFoundError:
+                pass
+
+    def run_once(self):
+        """1回分の掃除を行い、削除したバイト数を返す"""
+        self._flush_access_times()
+        now = time.time()
+        reclaimed = 0
+        files = []
+        if not os.path.isdir(self.directory):
+            return 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if entry.name.endswith(".tmp"):
+                # 書き込み途中で残った一時ファイル
+                if now - st.st_mtime > 3600:
+                    reclaimed += self._delete(entry.name, st.st_size)
+                continue
+            files.append({
+                "name": entry.name,
+                "size": st.st_size,
+                "last_used": max(st.st_atime, st.st_mtime),
+                "protected": now - st.st_mtime < self.protect_window,
+            })
+
+        remaining = []
+        for f in files:
+            if not f["protected"] and now - f["last_used"] > self.max_age:
+                reclaimed += self._delete(f["name"], f["size"])
+            else:
+                remaining.append(f)
+
+        total = sum(f["size"] for f in remaining)
+        kept = len(remaining)
+        if total > self.max_bytes:
+            for f in sorted((f for f in remaining if not f["protected"]), key=lambda f: f["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                freed = self._delete(f["name"], f["size"])
+                reclaimed += freed
+                total -= freed
+                kept -= 1
+            if total > self.max_bytes:
+                logger.warning(f"Image store over budget with only protected images left: {total} bytes")
+
+        self.runs += 1
+        self.last_run = now
+        self.dir_bytes = total
+        self.dir_files = kept
+        if reclaimed:
+            logger.info(f"Image janitor reclaimed {reclaimed} bytes, {total} bytes in use")
+        return reclaimed
+
+    def _delete(self, filename, size):
+        image_cache.discard(filename)
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            return 0
+        self.deleted_files += 1
+        self.reclaimed_bytes += size
+        return size
+
+    def stats(self):
+        return {
+            "max_bytes": self.max_bytes,
+            "max_age_hours": self.max_age / 3600,
+            "protect_hours": self.protect_window / 3600,
+            "bytes": self.dir_bytes,
+            "files": self.dir_files,
+            "runs": self.runs,
+            "last_run": datetime.fromtimestamp(self.last_run).isoformat() if self.last_run else None,
+            "deleted_files": self.deleted_files,
+            "reclaimed_bytes": self.reclaimed_bytes,
+        }
+
+
+image_janitor = ImageJanitor(
+    UPLOAD_DIR,
+    IMAGE_STORE_MAX_BYTES,
+    IMAGE_MAX_AGE_HOURS * 3600,
+    IMAGE_PROTECT_HOURS * 3600,
+    IMAGE_JANITOR_INTERVAL,
+)
+
+
+# ═══════════════════════════════════════════
+#  Webhookイベントキュー
+# ═══════════════════════════════════════════
+
+# /stats で公開する統計情報（名前 → dictを返す関数）
+STATS_PROVIDERS = {}
+
+
+def register_stats(name, provider):
+    """/stats に統計情報の提供関数を登録"""
+    STATS_PROVIDERS[name] = provider
+
+
+def dispatch_event(event, queued_ms=None):
+    """パース済みイベントを登録済みハンドラへ振り分ける（WebhookHandler.handleと同じ規則）"""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__, handler._default)
+    if func is None:
+        logger.info(f"No handler for {event.__class__.__name__}")
+        return
+    attrs = {"event_type": event.type, "source_type": getattr(event.source, "type", None)}
+    if queued_ms is not None:
+        attrs["queued_ms"] = round(queued_ms, 2)
+    with profiler.track(), tracer.trace("webhook", trace_id=getattr(event, "webhook_event_id", None), **attrs):
+        with tracer.span(func.__name__):
+            func(event)
+
+
+def event_session_key(event):
+    """イベントの実行順序を保証する単位（セッション）のキー"""
     try:
-        if font_bold_path and font_reg_path:
-            font_title = ImageFont.truetype(font_bold_path, 36)
-            font_day_header = ImageFont.truetype(font_bold_path, 20)
-            font_day_num = ImageFont.truetype(font_bold_path, 18)
-            font_name = ImageFont.truetype(font_reg_path, 13)
-            font_legend = ImageFont.truetype(font_reg_path, 14)
+        return get_session_key(event)
+    except AttributeError:
+        return "global"
+
+
+class SessionEventExecutor:
+    """イベントをセッションごとのレーンに積み、ワーカースレッドで処理する有界エグゼキュータ
+
+    同じセッションのイベントは到着順に1件ずつ処理し（user_sessionsの状態遷移が順序に依存するため）、
+    異なるセッションのイベントは並行して処理する。
+    """
+
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._pending = 0
+        self._closed = False
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.max_lane_depth = 0
+        self.max_wait = 0.0
+
+    def _ensure_started(self):
+        # preload後にforkされたプロセスにはスレッドが引き継がれないため、pidごとに起動する
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webhook-worker")
+            self._lanes = {}
+            self._pending = 0
+            self._pid = os.getpid()
+            logger.info(f"Webhook executor started: workers={self.workers}, maxsize={self.maxsize}")
+
+    def submit(self, event):
+        """イベントをセッションのレーンに積み、完了を待てるFutureを返す。停止中ならNone
+
+        満杯（maxsize件が処理待ち）のとき、そのセッションに処理待ちのイベントがあれば順序を守るため上限を超えてもレーンに積む。
+        処理待ちがなければ呼び出し元のスレッドで処理してから返す（Webhookの応答を遅らせて背圧をかける）。
+        その間に届いた同じセッションのイベントはレーンで待ち、処理後にワーカーへ引き継がれる。
+        """
+        if self._closed:
+            return None
+        self._ensure_started()
+        key = event_session_key(event)
+        future = Future()
+        with self._lock:
+            lane = self._lanes.get(key)
+            idle = lane is None
+            inline = idle and self._pending >= self.maxsize
+            if inline:
+                self.rejected += 1
+            if idle:
+                lane = self._lanes[key] = deque()
+            lane.append((event, future, time.monotonic()))
+            self._pending += 1
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self._pending)
+            self.max_lane_depth = max(self.max_lane_depth, len(lane))
+        if inline:
+            self._run_lane(key)
+        elif idle:
+            self._pool.submit(self._run_lane, key)
+        return future
+
+    def _run_lane(self, key):
+        # 1件処理するごとにプールへ戻し、長いレーンが他のセッションを待たせないようにする
+        with self._lock:
+            event, future, enqueued_at = self._lanes[key][0]
+        waited = time.monotonic() - enqueued_at
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            dispatch_event(event, queued_ms=waited * 1000)
+            self.processed += 1
+            future.set_result(None)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Webhook event handling error: {e}\n{traceback.format_exc()}")
+            future.set_exception(e)
+        with self._lock:
+            lane = self._lanes[key]
+            lane.popleft()
+            self._pending -= 1
+            if not lane:
+                del self._lanes[key]
+                return
+        self._pool.submit(self._run_lane, key)
+
+    def shutdown(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """新規受付を止め、処理中・待機中のイベントを処理し終えるまで待つ"""
+        if self._closed or self._pid != os.getpid():
+            self._closed = True
+            return
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        logger.info(f"Draining webhook executor: {self._pending} pending")
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self._pending:
+            logger.warning(f"Webhook executor drain timed out: {self._pending} pending")
         else:
-            raise FileNotFoundError("No suitable font found")
-    except Exception as e:
-        logger.warning(f"Font loading error: {e}, using default")
-        font_title = ImageFont.load_default()
-        font_day_header = ImageFont.load_default()
-        font_day_num = ImageFont.load_default()
-        font_name = ImageFont.load_default()
-        font_legend = ImageFont.load_default()
-
-    num_days = calendar.monthrange(year, month)[1]
-    first_weekday = calendar.monthrange(year, month)[0]
-    first_weekday_sun = (first_weekday + 1) % 7
-    total_cells = first_weekday_sun + num_days
-    num_rows = (total_cells + 6) // 7
-
-    all_therapists = set()
-    for day_shifts in cal_data.values():
-        for s in day_shifts:
-            all_therapists.add(s["name"])
-    therapist_list = sorted(all_therapists)
-    therapist_color_map = {}
-    for i, name in enumerate(therapist_list):
-        therapist_color_map[name] = THERAPIST_COLORS[i % len(THERAPIST_COLORS)]
-
-    cell_w = 150
-    cell_h = 110
-    header_h = 80
-    day_header_h = 35
-    legend_h = max(60, 30 + ((len(therapist_list) + 4) // 5) * 28)
-    padding = 15
-    img_w = cell_w * 7 + padding * 2
-    img_h = header_h + day_header_h + cell_h * num_rows + legend_h + padding * 2
-
-    bg_color = "#1a1a2e"
-    cell_bg = "#16213e"
-    cell_border = "#0f3460"
-    today_bg = "#e94560"
-    today_border = "#ff6b6b"
-    text_white = "#ffffff"
-    text_gray = "#a0a0a0"
-    sat_color = "#60A5FA"
-    sun_color = "#F87171"
-    header_bg = "#0f3460"
-
-    img = Image.new("RGB", (img_w, img_h), bg_color)
-    draw = ImageDraw.Draw(img)
-
-    draw.rectangle([0, 0, img_w, header_h], fill=header_bg)
-
-    title_text = f"{year}年{month}月 シフトカレンダー"
-    bbox = draw.textbbox((0, 0), title_text, font=font_title)
-    tw = bbox[2] - bbox[0]
-    draw.text(((img_w - tw) // 2, 20), title_text, fill="#f0e6d3", font=font_title)
-
-    weekdays = ["日", "月", "火", "水", "木", "金", "土"]
-    y_offset = header_h
-    for i, wd in enumerate(weekdays):
-        x = padding + i * cell_w
-        color = sun_color if i == 0 else (sat_color if i == 6 else text_white)
-        bbox = draw.textbbox((0, 0), wd, font=font_day_header)
-        tw = bbox[2] - bbox[0]
-        draw.text((x + (cell_w - tw) // 2, y_offset + 7), wd, fill=color, font=font_day_header)
-
-    y_offset += day_header_h
+            logger.info("Webhook executor drained")
+        self._pool.shutdown(wait=False)
 
-    today_val = date.today()
-    day_num = 1
-    for row in range(num_rows):
-        for col in range(7):
-            cell_index = row * 7 + col
-            if cell_index < first_weekday_sun or day_num > num_days:
-                continue
+    def stats(self):
+        with self._lock:
+            # レーンのキーはLINEのユーザー・グループIDなので、件数と深さだけを返す
+            lane_depths = [len(lane) for lane in self._lanes.values()]
+        return {
+            "async": WEBHOOK_ASYNC,
+            "workers": self.workers,
+            "maxsize": self.maxsize,
+            "depth": self._pending,
+            "max_depth": self.max_depth,
+            "active_sessions": len(lane_depths),
+            "deepest_lane": max(lane_depths, default=0),
+            "max_lane_depth": self.max_lane_depth,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
 
-            x = padding + col * cell_w
-            y = y_offset + row * cell_h
 
-            is_today = (year == today_val.year and month == today_val.month and day_num == today_val.day)
-            bg = today_bg if is_today else cell_bg
-            border = today_border if is_today else cell_border
+event_executor = SessionEventExecutor(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+register_stats("webhook_queue", event_executor.stats)
+register_stats("notion", notion_client.stats)
+register_stats("line", line_client.stats)
+register_stats("tracing", tracer.stats)
+register_stats("profiler", profiler.stats)
+register_stats("shift_cache", shift_cache.stats)
+register_stats("calendar_images", calendar_store.stats)
+register_stats("calendar_render_pool", calendar_renderer.stats)
+register_stats("image_cache", image_cache.stats)
+register_stats("image_janitor", image_janitor.stats)
+if shift_mirror:
+    register_stats("shift_mirror", shift_mirror.stats)
 
-            draw.rectangle([x, y, x + cell_w - 1, y + cell_h - 1], fill=bg, outline=border, width=2)
 
-            day_str = str(day_num)
-            bbox = draw.textbbox((0, 0), day_str, font=font_day_num)
-            tw = bbox[2] - bbox[0]
-            draw.text((x + (cell_w - tw) // 2, y + 5), day_str, fill=text_white, font=font_day_num)
+def drain_background_work(timeout=WEBHOOK_DRAIN_TIMEOUT):
+    """Webhookイベントを処理し切ってから、それが積んだニュース生成ジョブを待つ
 
-            shifts = cal_data.get(day_num, [])
-            name_y = y + 30
-            for shift in shifts[:3]:
-                name = shift["name"]
-                condition = shift["condition"]
-                color = therapist_color_map.get(name, text_white)
-                text = f"{name} {condition}"
-                draw.text((x + 5, name_y), text, fill=color, font=font_name)
-                name_y += 18
+    2つの待ちで1つの期限を共有し、合計でtimeout秒を超えないようにする（gunicornのgraceful_timeout内に収めるため）。
+    """
+    deadline = time.monotonic() + timeout
+    event_executor.shutdown(timeout=timeout)
+    news_jobs.shutdown(timeout=max(0.0, deadline - time.monotonic()))
 
-            if len(shifts) > 3:
-                draw.text((x + 5, name_y), f"+{len(shifts) - 3}名", fill=text_gray, font=font_name)
 
-            day_num += 1
+atexit.register(drain_background_work)
 
-    legend_y = y_offset + num_rows * cell_h + 10
-    draw.text((padding, legend_y), "セラピスト凡例:", fill=text_white, font=font_legend)
-    legend_y += 25
 
-    col_count = 5
-    for i, name in enumerate(therapist_list):
-        col = i % col_count
-        row = i // col_count
-        x = padding + col * (img_w // col_count)
-        y = legend_y + row * 28
-        color = therapist_color_map[name]
-        draw.rectangle([x, y, x + 15, y + 15], fill=color)
-        draw.text((x + 20, y), name, fill=text_white, font=font_legend)
+def warm_up():
+    """初回利用時まで遅らせている重い依存の読み込み・クライアント作成・フォント読み込み・固定Flexの構築を前もって行う
 
-    return img
+    WARM_UP=1 ならインポート時に実行する（gunicornの--preloadでは親プロセスで1回だけ済ませ、workerはfork後に共有する）。
+    """
+    started = time.perf_counter()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    log_x_credentials()
+    get_openai_client()
+    import tweepy  # noqa: F401
+    fonts.preload(CALENDAR_FONT_SPECS)
+    build_main_menu_flex()
+    build_news_category_select_flex()
+    build_schedule_month_select_flex()
+    logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f}ms")
 
 
 # ═══════════════════════════════════════════
 #  Flask ルート
 # ═══════════════════════════════════════════
 
+@app.before_request
+def ensure_background_services():
+    # gunicornのworkerごとに、最初のリクエストでバックグラウンドスレッドを起動する
+    if shift_mirror:
+        shift_mirror.start()
+    calendar_renderer.start()
+    image_janitor.start()
+    metrics.start()
+
+
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     logger.info(f"Request body: {body}")
 
+    # 署名検証とパースだけをリクエストスレッドで行い、処理はセッションごとのレーンに任せる
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         logger.error("Invalid signature")
         abort(400)
 
+    if not WEBHOOK_ASYNC and len(events) <= 1:
+        for event in events:
+            dispatch_event(event)
+        return "OK"
+
+    futures = []
+    for event in events:
+        future = event_executor.submit(event)
+        if future is None:
+            # 停止中（worker終了時）に届いたイベントは落とさずインラインで処理する
+            logger.warning("Webhook executor closed, handling event inline")
+            try:
+                dispatch_event(event)
+            except Exception as e:
+                logger.error(f"Webhook event handling error: {e}\n{traceback.format_exc()}")
+        else:
+            futures.append(future)
+
+    if not WEBHOOK_ASYNC:
+        # 同期モードでも複数セッションのイベントは並行に処理し、全件の完了を待って返す
+        wait(futures)
+
     return "OK"
 
 
+def require_diagnostics_access(view):
+    """localhostからのアクセス、または DIAGNOSTICS_TOKEN を Bearer で送ったリクエストだけを通す"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        auth = request.headers.get("Authorization", "")
+        if DIAGNOSTICS_TOKEN and hmac.compare_digest(auth.encode(), f"Bearer {DIAGNOSTICS_TOKEN}".encode()):
+            return view(*args, **kwargs)
+        try:
+            local = ipaddress.ip_address(request.remote_addr or "").is_loopback
+        except ValueError:
+            local = False
+        # プロキシ経由のリクエストはremote_addrがプロキシになるため、転送ヘッダーが付いていればlocalhost扱いしない
+        if local and "X-Forwarded-For" not in request.headers:
+            return view(*args, **kwargs)
+        abort(401 if DIAGNOSTICS_TOKEN else 403)
+    return wrapper
+
+
+@app.route("/stats")
+@require_diagnostics_access
+def stats():
+    return jsonify({name: provider() for name, provider in STATS_PROVIDERS.items()})
+
+
+@app.route("/metrics")
+@require_diagnostics_access
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/profiles/<filename>")
+def serve_profile(filename):
+    path = safe_join(PROFILE_DIR, filename)
+    if path is None or not filename.startswith("profile-") or not os.path.isfile(path):
+        abort(404)
+    with open(path, "rb") as f:
+        data = f.read()
+    resp = Response(data, mimetype="text/plain")
+    resp.headers["Content-Disposition"] = f'attachment; filename="{os.path.basename(path)}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
 @app.route("/")
 def index():
     return jsonify({
@@ -802,15 +2669,35 @@ def index():
 
 @app.route("/static/images/<path:filename>")
 def serve_image(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+    # 生成画像はファイル名ごとに内容が変わらないため、immutableで長期キャッシュさせる
+    entry = image_cache.get(filename)
+    if entry is None:
+        path = safe_join(UPLOAD_DIR, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        with open(path, "rb") as f:
+            entry = image_cache.put(filename, f.read())
+    data, etag = entry
+    image_janitor.touch(filename)
+
+    if etag in request.if_none_match:
+        image_cache.not_modified += 1
+        resp = Response(status=304)
+    else:
+        image_cache.bytes_served += len(data)
+        resp = Response(data, mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
 
 
 # ═══════════════════════════════════════════
 #  Flex Message構築
 # ═══════════════════════════════════════════
 
+@functools.lru_cache(maxsize=None)
 def build_main_menu_flex():
-    """メインメニューのFlex Message"""
+    """メインメニューのFlex Message（内容は固定なので初回に1度だけ構築・検証して使い回す）"""
     flex_json = {
         "type": "bubble",
         "size": "mega",
@@ -890,37 +2777,59 @@ def make_menu_button(label, text):
     }
 
 
-def build_upcoming_shifts_flex(shifts):
-    """直近の出勤情報のFlex Message"""
+def build_upcoming_shifts_rows(shifts, max_bytes):
+    """出勤情報の行（日付見出し・区切り・シフト）を、JSONの合計がmax_bytesを超えない分だけ作り (行, 省略件数) を返す"""
+    content = []
+    used = 0
+    current_date = ""
+    for i, s in enumerate(shifts):
+        rows = []
+        if s["date"] != current_date:
+            dt_parsed = parse_date_safe(s["date"])
+            dt = datetime.combine(dt_parsed, datetime.min.time()) if dt_parsed else datetime.now()
+            rows.append({
+                "type": "text",
+                "text": f"📅 {dt.strftime('%m/%d')}({['月','火','水','木','金','土','日'][dt.weekday()]})",
+                "weight": "bold",
+                "size": "sm",
+                "margin": "lg",
+                "color": "#0f3460"
+            })
+            rows.append({"type": "separator", "margin": "xs"})
+        rows.append({
+            "type": "box",
+            "layout": "horizontal",
+            "contents": [
+                {"type": "text", "text": s["name"], "weight": "bold", "size": "sm", "flex": 3},
+                {"type": "text", "text": s["condition"], "size": "sm", "flex": 3},
+                {"type": "text", "text": s["room"], "size": "xs", "color": "#888888", "flex": 4, "align": "end"}
+            ],
+            "margin": "sm"
+        })
+        # SDKは json.dumps の既定（ASCIIエスケープ）で送るため、日本語は1文字6バイトとして測る
+        size = sum(len(json.dumps(row)) + 1 for row in rows)
+        if used + size > max_bytes:
+            return content, len(shifts) - i
+        used += size
+        content.extend(rows)
+        current_date = s["date"]
+    return content, 0
+
+
+def build_upcoming_shifts_flex(shifts, days=7):
+    """直近の出勤情報のFlex Message（LINEのバブルの大きさの上限を超える分は件数だけ表示する）"""
     if not shifts:
         content = [{"type": "text", "text": "直近の出勤予定はありません", "align": "center", "margin": "md"}]
     else:
-        content = []
-        current_date = ""
-        for s in shifts:
-            if s["date"] != current_date:
-                current_date = s["date"]
-                dt_parsed = parse_date_safe(current_date)
-                dt = datetime.combine(dt_parsed, datetime.min.time()) if dt_parsed else datetime.now()
-                content.append({
-                    "type": "text",
-                    "text": f"📅 {dt.strftime('%m/%d')}({['月','火','水','木','金','土','日'][dt.weekday()]})",
-                    "weight": "bold",
-                    "size": "sm",
-                    "margin": "lg",
-                    "color": "#0f3460"
-                })
-                content.append({"type": "separator", "margin": "xs"})
-            
+        content, omitted = build_upcoming_shifts_rows(shifts, UPCOMING_FLEX_MAX_BYTES)
+        if omitted:
             content.append({
-                "type": "box",
-                "layout": "horizontal",
-                "contents": [
-                    {"type": "text", "text": s["name"], "weight": "bold", "size": "sm", "flex": 3},
-                    {"type": "text", "text": s["condition"], "size": "sm", "flex": 3},
-                    {"type": "text", "text": s["room"], "size": "xs", "color": "#888888", "flex": 4, "align": "end"}
-                ],
-                "margin": "sm"
+                "type": "text",
+                "text": f"…ほか{omitted}件（日数を減らすと全件表示できます）",
+                "size": "xs",
+                "color": "#888888",
+                "margin": "lg",
+                "wrap": True
             })
 
     flex_json = {
@@ -929,7 +2838,7 @@ def build_upcoming_shifts_flex(shifts):
         "header": {
             "type": "box",
             "layout": "vertical",
-            "contents": [{"type": "text", "text": "🚶 直近1週間の出勤情報", "weight": "bold", "size": "lg", "align": "center"}],
+            "contents": [{"type": "text", "text": f"🚶 直近{'1週間' if days == 7 else f'{days}日間'}の出勤情報", "weight": "bold", "size": "lg", "align": "center"}],
             "backgroundColor": "#f0e6d3",
             "paddingAll": "15px"
         },
@@ -945,12 +2854,248 @@ def build_upcoming_shifts_flex(shifts):
     return FlexMessage(alt_text="出勤情報", contents=FlexContainer.from_dict(flex_json))
 
 
+# ═══════════════════════════════════════════
+#  診断（管理者用）
+# ═══════════════════════════════════════════
+
+def format_ratio(numerator, denominator):
+    return f"{numerator / denominator * 100:.0f}%" if denominator else "-"
+
+
+def format_bucket_ms(ms):
+    """パーセンタイルはバケット上限の近似値なので ≤ を付ける"""
+    if ms is None:
+        return "-"
+    if ms == float("inf"):
+        return ">10s"
+    return f"≤{ms / 1000:g}s" if ms >= 1000 else f"≤{ms:g}ms"
+
+
+def collect_diagnostics():
+    """診断Flexに表示する値（処理時間は全プロセス合算、それ以外はこのプロセスの値）"""
+    stages = metrics.summary("zenryoku_stage", "stage")
+    commands = metrics.summary("zenryoku_command", "command")
+    stage_totals = {}
+    for row in stages:
+        if row["stage"].endswith(".wait"):
+            continue
+        upstream = row["stage"].split(".")[0]
+        total = stage_totals.setdefault(upstream, {"count": 0, "errors": 0})
+        total["count"] += row["count"]
+        total["errors"] += row["errors"]
+
+    notion = notion_client.stats()
+    sessions = user_sessions.stats()
+    flex = flex_cache_stats().values()
+    return {
+        "stages": sorted(stages, key=lambda r: (-(r["p95_ms"] or 0), -r["count"]))[:8],
+        "commands": sorted(commands, key=lambda r: (-(r["p95_ms"] or 0), -r["count"]))[:5],
+        "caches": [
+            ("シフト", shift_cache.hits + shift_cache.stale_hits,
+             shift_cache.hits + shift_cache.stale_hits + shift_cache.misses),
+            ("カレンダー画像", calendar_store.hits, calendar_store.hits + calendar_store.renders),
+            ("画像配信", image_cache.hits, image_cache.hits + image_cache.misses),
+            ("セッション", sessions["hits"], sessions["hits"] + sessions["misses"]),
+            ("Flex", sum(f["hits"] for f in flex), sum(f["hits"] + f["misses"] for f in flex)),
+            ("下書きバッファ", news_draft_stats.buffer_hits, news_draft_stats.buffer_hits + news_draft_stats.buffer_misses),
+        ],
+        "queue": event_executor.stats(),
+        "shift_mirror": shift_mirror.stats() if shift_mirror else None,
+        "upstreams": [
+            ("Notion", notion["errors"], notion["requests"], notion["retries"]),
+            ("LINE", stage_totals.get("line", {}).get("errors", 0), stage_totals.get("line", {}).get("count", 0),
+             line_client.retries),
+            ("OpenAI", stage_totals.get("openai", {}).get("errors", 0), stage_totals.get("openai", {}).get("count", 0), None),
+            ("X", stage_totals.get("x", {}).get("errors", 0), stage_totals.get("x", {}).get("count", 0), None),
+        ],
+    }
+
+
+def diagnostics_row(cells, bold=False):
+    """列の幅（flex）を揃えた1行"""
+    contents = []
+    for i, (text, flex) in enumerate(cells):
+        cell = {"type": "text", "text": str(text), "size": "xs", "flex": flex, "align": "start" if i == 0 else "end"}
+        if bold:
+            cell.update({"weight": "bold", "color": "#888888"})
+        contents.append(cell)
+    return {"type": "box", "layout": "horizontal", "contents": contents, "margin": "sm"}
+
+
+def diagnostics_heading(text):
+    return [
+        {"type": "text", "text": text, "weight": "bold", "size": "sm", "margin": "lg", "color": "#0f3460"},
+        {"type": "separator", "margin": "xs"},
+    ]
+
+
+def build_diagnostics_flex(diag):
+    """管理者向けの診断サマリーのFlex Message"""
+    content = diagnostics_heading("⏱ 処理時間（遅い順）")
+    content.append(diagnostics_row([("工程", 5), ("件数", 2), ("p50", 2), ("p95", 2), ("失敗", 2)], bold=True))
+    for row in diag["stages"]:
+        content.append(diagnostics_row([(row["stage"], 5), (row["count"], 2), (format_bucket_ms(row["p50_ms"]), 2),
+                                        (format_bucket_ms(row["p95_ms"]), 2), (row["errors"], 2)]))
+    for row in diag["commands"]:
+        content.append(diagnostics_row([(f"cmd:{row['command']}", 5), (row["count"], 2), (format_bucket_ms(row["p50_ms"]), 2),
+                                        (format_bucket_ms(row["p95_ms"]), 2), (row["errors"], 2)]))
+    if not diag["stages"] and not diag["commands"]:
+        content.append({"type": "text", "text": "まだ記録がありません", "size": "xs", "color": "#888888", "margin": "sm"})
+
+    content += diagnostics_heading("🗃 キャッシュヒット率")
+    for name, hits, lookups in diag["caches"]:
+        content.append(diagnostics_row([(name, 5), (f"{hits}/{lookups}", 4), (format_ratio(hits, lookups), 3)]))
+
+    queue = diag["queue"]
+    content += diagnostics_heading("📥 Webhookキュー")
+    content.append(diagnostics_row([("待機中 / 最大", 5), (f"{queue['depth']} / {queue['max_depth']}", 7)]))
+    content.append(diagnostics_row([("処理中セッション", 5), (queue["active_sessions"], 7)]))
+    content.append(diagnostics_row([("最大待ち時間", 5), (f"{queue['max_wait_ms']}ms", 7)]))
+    content.append(diagnostics_row([("失敗 / 満杯でインライン", 5), (f"{queue['failed']} / {queue['rejected']}", 7)]))
+
+    mirror = diag["shift_mirror"]
+    if mirror and mirror.get("started"):
+        age = mirror["last_sync_age_seconds"]
+        content += diagnostics_heading("🔁 シフトミラー")
+        content.append(diagnostics_row([("最終同期", 5), ("未同期" if age is None else f"{age:.0f}秒前", 7)]))
+        content.append(diagnostics_row([("状態", 5), ("⚠️ 同期が止まっています" if mirror["stale"] else "正常", 7)]))
+
+    content += diagnostics_heading("🌐 外部APIのエラー率")
+    content.append(diagnostics_row([("API", 5), ("失敗/呼出", 4), ("率", 2), ("再試行", 2)], bold=True))
+    for name, errors, calls, retries in diag["upstreams"]:
+        content.append(diagnostics_row([(name, 5), (f"{errors}/{calls}", 4), (format_ratio(errors, calls), 2),
+                                        ("-" if retries is None else retries, 2)]))
+
+    flex_json = {
+        "type": "bubble",
+        "size": "giga",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": "🩺 診断", "weight": "bold", "size": "lg", "align": "center"},
+                {"type": "text", "text": f"起動後の累計（pid {os.getpid()}・処理時間は全worker合算）", "size": "xxs",
+                 "color": "#888888", "align": "center", "margin": "sm"},
+            ],
+            "backgroundColor": "#f0e6d3",
+            "paddingAll": "15px"
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": content + [
+                {"type": "button", "action": {"type": "message", "label": "🔬 プロファイル（次の20件）", "text": "プロファイル 20"},
+                 "style": "primary", "color": "#0f3460", "margin": "xl"},
+                {"type": "button", "action": {"type": "message", "label": "🔙 メニューに戻る", "text": "メニュー"},
+                 "style": "secondary", "margin": "sm"},
+            ],
+            "paddingAll": "15px"
+        }
+    }
+    return FlexMessage(alt_text="診断", contents=FlexContainer.from_dict(flex_json))
+
+
+def build_profile_result_message(filename, summary):
+    """プロファイル完了の通知（ダウンロードURLと実行中だった関数の上位）"""
+    lines = [f"🔬 プロファイルが完了しました（{summary['events']}件・{summary['seconds']}秒・{summary['samples']}サンプル）"]
+    if filename:
+        lines.append(f"\n📥 {BASE_URL}/profiles/{filename}")
+        lines.append("（folded形式。speedscope や flamegraph.pl で表示できます）")
+    else:
+        lines.append("\n⚠️ プロファイルの保存に失敗しました。")
+    if summary["top"]:
+        lines.append("\n実行中だった関数（上位）:")
+        lines.extend(f"・{pct}% {name}" for name, pct in summary["top"])
+    return TextMessage(text="\n".join(lines)[:5000])
+
+
 # ═══════════════════════════════════════════
 #  ニュース生成
 # ═══════════════════════════════════════════
 
-def generate_news(topic=None):
-    """OpenAI APIでニュース文面を自動生成"""
+openai_semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+
+
+@contextlib.contextmanager
+def openai_slot():
+    """OpenAI APIの同時呼び出しを OPENAI_MAX_CONCURRENCY 件までに制限する（空き待ちの時間は openai.wait に記録）"""
+    with metrics.timed("zenryoku_stage", stage="openai.wait"), tracer.span("openai.wait"):
+        openai_semaphore.acquire()
+    try:
+        yield
+    finally:
+        openai_semaphore.release()
+
+
+class NewsDraftStats:
+    """下書きバッファのヒット率と、保存した記事あたりのOpenAIトークン消費"""
+
+    def __init__(self):
+        self.buffer_hits = 0
+        self.buffer_misses = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.drafts_generated = 0
+        self.saved_articles = 0
+
+    def hit(self):
+        self.buffer_hits += 1
+        metrics.inc("zenryoku_news_draft_buffer_total", result="hit")
+
+    def miss(self):
+        self.buffer_misses += 1
+        metrics.inc("zenryoku_news_draft_buffer_total", result="miss")
+
+    def spent(self, usage, drafts):
+        """生成リクエスト1回分のトークン消費（保存されなかった下書きの分も含めて数える）"""
+        self.drafts_generated += drafts
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+        metrics.inc("zenryoku_openai_tokens_total", usage.prompt_tokens or 0, kind="prompt")
+        metrics.inc("zenryoku_openai_tokens_total", usage.completion_tokens or 0, kind="completion")
+
+    def saved(self):
+        self.saved_articles += 1
+        metrics.inc("zenryoku_news_saved_total")
+
+    def stats(self):
+        regenerations = self.buffer_hits + self.buffer_misses
+        tokens = self.prompt_tokens + self.completion_tokens
+        return {
+            "drafts_per_request": NEWS_DRAFTS,
+            "buffer_hits": self.buffer_hits,
+            "buffer_misses": self.buffer_misses,
+            "buffer_hit_ratio": round(self.buffer_hits / regenerations, 3) if regenerations else None,
+            "drafts_generated": self.drafts_generated,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "saved_articles": self.saved_articles,
+            "tokens_per_saved_article": round(tokens / self.saved_articles) if self.saved_articles else None,
+        }
+
+
+news_draft_stats = NewsDraftStats()
+register_stats("news_drafts", news_draft_stats.stats)
+
+
+def parse_news_content(content):
+    """生成結果（```json で囲まれていてもよい）から {"title", "body"} を取り出す。読めなければValueError"""
+    content = content.strip()
+    if "```json" in content:
+        content = content.split("```json")[1].split("```")[0].strip()
+    elif "```" in content:
+        content = content.split("```")[1].split("```")[0].strip()
+    result = json.loads(content)
+    if not isinstance(result, dict):
+        raise ValueError(f"unexpected draft: {content[:100]}")
+    return result
+
+
+@timed_stage("openai.generate_news")
+def generate_news(topic=None, n=1):
+    """OpenAI APIでニュース文面の下書きを n 件まとめて生成し、リストで返す（失敗時はエラー文面の1件）"""
     prompt = f"""あなたはメンズエステサロン「全力エステ」の広報担当です。
 エステ魂（メンズエステ情報サイト）向けのニュース記事を作成してください。
 
@@ -972,29 +3117,159 @@ def generate_news(topic=None):
 {{"title": "タイトル", "body": "本文"}}
 """
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.8,
-            max_tokens=2000,
-        )
-        content = response.choices[0].message.content.strip()
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
-        result = json.loads(content)
-        return result
+        with openai_slot():
+            response = get_openai_client().chat.completions.create(
+                model="gpt-4.1-mini",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.8,
+                max_tokens=2000,
+                n=n,
+            )
+        drafts = []
+        for choice in response.choices:
+            try:
+                drafts.append(parse_news_content(choice.message.content or ""))
+            except ValueError as e:
+                logger.warning(f"Skipping unparsable news draft: {e}")
+        news_draft_stats.spent(response.usage, len(drafts))
+        if not drafts:
+            raise ValueError("no parsable draft in the response")
+        return drafts
     except Exception as e:
+        record_stage_error("openai.generate_news")
         logger.error(f"News generation error: {e}")
-        return {
+        return [{
             "title": "全力エステからのお知らせ",
             "body": "ニュースの生成中にエラーが発生しました。もう一度お試しください。"
+        }]
+
+
+class NewsJobRunner:
+    """ニュース生成をWebhookの処理から切り離して実行するバックグラウンドジョブ
+
+    ジョブIDをセッションに保存し、同じセッションで新しい生成が依頼されたら古いジョブは
+    開始前なら取り消し、実行中なら結果を捨てる（セッションのジョブIDが変わっていれば反映しない）。
+    完了したジョブはセッションをプレビュー状態にして確認Flexをpushする。
+    """
+
+    OUTCOMES = ("completed", "cancelled", "superseded", "failed")
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = None
+        self._pid = None
+        # cancel()は完了コールバックをその場で呼ぶため、ロック内から呼べるようRLockにする
+        self._lock = threading.RLock()
+        self._futures = {}
+        self._closed = False
+        self.submitted = 0
+        self.running = 0
+        self.counts = {outcome: 0 for outcome in self.OUTCOMES}
+        self.durations = {outcome: metrics.histogram("zenryoku_news_job_duration_seconds", outcome=outcome)
+                          for outcome in self.OUTCOMES}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="news-job")
+            self._futures = {}
+            self._pid = os.getpid()
+
+    def submit(self, session_key, push_target, category, topic):
+        """セッションを生成中にしてジョブを積む。同じセッションの古いジョブは置き換える"""
+        self._ensure_started()
+        job_id = uuid.uuid4().hex[:12]
+        user_sessions.set(session_key, {"state": "news_generating", "category": category, "topic": topic, "job_id": job_id})
+        with self._lock:
+            previous = self._futures.get(session_key)
+            if previous is not None and previous.cancel():
+                self._record("cancelled", 0)
+            future = self._pool.submit(self._run, job_id, session_key, push_target, category, topic, time.perf_counter())
+            self._futures[session_key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda f: self._forget(session_key, f))
+        return job_id
+
+    def _forget(self, session_key, future):
+        with self._lock:
+            if self._futures.get(session_key) is future:
+                del self._futures[session_key]
+
+    @staticmethod
+    def _is_current(session_key, job_id):
+        session = user_sessions.get(session_key, {})
+        return session.get("state") == "news_generating" and session.get("job_id") == job_id
+
+    def _record(self, outcome, elapsed_ms):
+        self.counts[outcome] += 1
+        self.durations[outcome].observe(elapsed_ms)
+        metrics.inc("zenryoku_news_jobs_total", outcome=outcome)
+
+    def _run(self, job_id, session_key, push_target, category, topic, submitted_at):
+        self.running += 1
+        outcome = "failed"
+        try:
+            with tracer.trace("news_job", trace_id=job_id, category=category) as root:
+                outcome = self._generate(job_id, session_key, push_target, category, topic)
+                if root:
+                    root.set(outcome=outcome)
+        except Exception as e:
+            logger.error(f"News job {job_id} failed: {e}\n{traceback.format_exc()}")
+        finally:
+            self.running -= 1
+            self._record(outcome, (time.perf_counter() - submitted_at) * 1000)
+
+    def _generate(self, job_id, session_key, push_target, category, topic):
+        # 待っている間にメニューへ戻った・再生成されたジョブはOpenAIを呼ばずに終える
+        if not self._is_current(session_key, job_id):
+            return "cancelled"
+        news, *drafts = generate_news(topic, n=NEWS_DRAFTS)
+        # 確認と書き込みの間に再生成されても上書きしないよう、セッションがこのジョブのままのときだけ置き換える
+        # 残りの下書きは「再生成」ですぐに表示できるようセッションに取っておく
+        if not user_sessions.set_if(session_key, {
+                "state": "news_preview", "news": news, "drafts": drafts, "category": category, "topic": topic},
+                state="news_generating", job_id=job_id):
+            return "superseded"
+        if push_target:
+            get_messaging_api().push_message(PushMessageRequest(
+                to=push_target, messages=[build_news_confirm_flex(news, category)]))
+        return "completed"
+
+    def shutdown(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """実行中・待機中のジョブの完了を待つ（2回目以降は何もしない）"""
+        if self._closed or self._pid != os.getpid():
+            self._closed = True
+            return
+        self._closed = True
+        with self._lock:
+            futures = list(self._futures.values())
+        if futures:
+            logger.info(f"Waiting for {len(futures)} news jobs")
+            wait(futures, timeout=timeout)
+        self._pool.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "openai_max_concurrency": OPENAI_MAX_CONCURRENCY,
+            "submitted": self.submitted,
+            "running": self.running,
+            "queued": max(0, len(self._futures) - self.running),
+            **self.counts,
+            "duration": {outcome: histogram.snapshot() for outcome, histogram in self.durations.items()},
         }
 
 
+news_jobs = NewsJobRunner(OPENAI_MAX_CONCURRENCY)
+register_stats("news_jobs", news_jobs.stats)
+
+
+@functools.lru_cache(maxsize=None)
 def build_news_category_select_flex():
-    """ニュースカテゴリ選択のFlex Message"""
+    """ニュースカテゴリ選択のFlex Message（固定内容のため使い回す）"""
     flex_json = {
         "type": "bubble",
         "size": "mega",
@@ -1052,7 +3327,7 @@ def build_news_confirm_flex(news_data, category):
                 {"type": "text", "text": f"カテゴリ: {category}", "size": "xs", "color": "#888888", "margin": "md"},
                 {"type": "separator", "margin": "md"},
                 {"type": "text", "text": display_body, "size": "sm", "wrap": True, "margin": "md"},
-                {"type": "text", "text": f"（全{len(body)}文字）", "size": "xs", "color": "#888888", "align": "right", "margin": "sm"},
+                {"type": "text", "text": f"（全{len(body)}文字）", "size": "xs", "color": "#888888", "align": "end", "margin": "sm"},
                 {"type": "separator", "margin": "lg"},
                 {"type": "box", "layout": "vertical", "contents": [
                     {"type": "button", "action": {"type": "message", "label": "✅ この内容で保存", "text": "ニュース保存"}, "style": "primary", "color": "#1a1a2e"},
@@ -1162,7 +3437,7 @@ def build_news_detail_flex(news):
                 {"type": "text", "text": f"カテゴリ: {category} | {status}", "size": "xs", "color": "#888888", "margin": "md"},
                 {"type": "separator", "margin": "md"},
                 {"type": "text", "text": display_body, "size": "sm", "wrap": True, "margin": "md"},
-                {"type": "text", "text": f"（全{len(body)}文字）", "size": "xs", "color": "#888888", "align": "right", "margin": "sm"},
+                {"type": "text", "text": f"（全{len(body)}文字）", "size": "xs", "color": "#888888", "align": "end", "margin": "sm"},
                 {"type": "separator", "margin": "lg"},
                 {"type": "button", "action": {"type": "message", "label": "🔙 一覧に戻る", "text": "ニュース一覧"}, "style": "secondary", "margin": "lg"}
             ],
@@ -1259,7 +3534,7 @@ def build_x_post_confirm_flex(post_text):
                 {"type": "text", "text": "以下の内容でXに投稿します", "size": "sm", "color": "#888888", "align": "center", "margin": "md"},
                 {"type": "separator", "margin": "lg"},
                 {"type": "text", "text": display_text, "size": "sm", "wrap": True, "margin": "md"},
-                {"type": "text", "text": f"（{len(post_text)}文字）", "size": "xs", "color": "#888888", "align": "right", "margin": "sm"},
+                {"type": "text", "text": f"（{len(post_text)}文字）", "size": "xs", "color": "#888888", "align": "end", "margin": "sm"},
                 {"type": "separator", "margin": "lg"},
                 {"type": "box", "layout": "vertical", "contents": [
                     {"type": "button", "action": {"type": "message", "label": "\u2705 投稿する", "text": "X投稿実行"}, "style": "primary", "color": "#1a1a2e"},
@@ -1274,10 +3549,16 @@ def build_x_post_confirm_flex(post_text):
 
 
 def build_schedule_month_select_flex():
-    """スケジュール月選択のFlex Message"""
+    """スケジュール月選択のFlex Message（今月の分をキャッシュから返す）"""
     now = datetime.now()
-    this_month = f"{now.month}月"
-    next_month = "1月" if now.month == 12 else f"{now.month + 1}月"
+    return build_schedule_month_select_flex_for(now.year, now.month)
+
+
+@functools.lru_cache(maxsize=4)
+def build_schedule_month_select_flex_for(year, month):
+    """指定年月を「今月」とするスケジュール月選択のFlex Message"""
+    this_month = f"{month}月"
+    next_month = "1月" if month == 12 else f"{month + 1}月"
 
     flex_json = {
         "type": "bubble",
@@ -1305,12 +3586,25 @@ def build_schedule_month_select_flex():
     return FlexMessage(alt_text="スケジュール確認 - 月を選択", contents=FlexContainer.from_dict(flex_json))
 
 
+def flex_cache_stats():
+    """固定Flex Messageのキャッシュ状況"""
+    stats = {}
+    for builder in (build_main_menu_flex, build_news_category_select_flex, build_schedule_month_select_flex_for):
+        info = builder.cache_info()
+        stats[builder.__name__] = {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+    return stats
+
+
+register_stats("flex_cache", flex_cache_stats)
+
+
 def process_schedule_request(year, month, event):
     """スケジュールリクエストを処理してカレンダー画像を送信"""
     line_api = get_messaging_api()
     push_target = get_push_target(event)
 
-    shift_data = fetch_shift_data_from_notion(year, month)
+    with tracer.span("fetch_shift_data_from_notion", year=year, month=month):
+        shift_data = fetch_shift_data_from_notion(year, month)
     
     if not shift_data:
         if push_target:
@@ -1331,22 +3625,219 @@ def process_schedule_request(year, month, event):
     else:
         today_text += "本日の出勤予定はありません。"
 
-    cal_data = parse_shift_to_calendar(shift_data, year, month)
-    img = generate_calendar_image(year, month, cal_data)
-    filename = f"schedule_{year}_{month:02d}_{uuid.uuid4().hex[:8]}.png"
-    filepath = os.path.join(UPLOAD_DIR, filename)
-    img.save(filepath, "PNG")
-
-    image_url = f"{BASE_URL}/static/images/{filename}"
+    with tracer.span("parse_shift_to_calendar", shifts=len(shift_data)):
+        cal_data = parse_shift_to_calendar(shift_data, year, month)
+    with tracer.span("calendar.get_or_render"):
+        filename, preview_filename = calendar_store.get_or_render(year, month, cal_data, today=today_val)
 
     if push_target:
+        missing = image_janitor.mark_sent(filename, preview_filename)
+        if missing:
+            # 存在確認から保護までの間に他プロセスの掃除で削除された場合は描画し直す
+            logger.warning(f"Calendar image removed before sending, re-rendering: {', '.join(missing)}")
+            with tracer.span("calendar.get_or_render", retry=True):
+                filename, preview_filename = calendar_store.get_or_render(year, month, cal_data, today=today_val)
+            image_janitor.mark_sent(filename, preview_filename)
+        image_url = f"{BASE_URL}/static/images/{filename}"
+        preview_url = f"{BASE_URL}/static/images/{preview_filename}"
         line_api.push_message(PushMessageRequest(to=push_target, messages=[
             TextMessage(text=today_text),
             TextMessage(text=f"📅 {year}年{month}月のシフトカレンダーです"),
-            ImageMessage(original_content_url=image_url, preview_image_url=image_url)
+            ImageMessage(original_content_url=image_url, preview_image_url=preview_url)
         ]))
 
 
+# ═══════════════════════════════════════════
+#  セッションストア
+# ═══════════════════════════════════════════
+
+def session_size(value):
+    """セッション1件のおおよそのバイト数"""
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class MemorySessionStore:
+    """LRU + TTLのメモリ上セッションストア
+
+    キーのハッシュでロックを分割（ストライピング）し、各ストライプが件数・バイト数の上限を
+    等分して持つ。上限を超えたら最終アクセスの古い順に追い出す。
+    返す値は共有されているため、呼び出し側は書き換えずに set() で置き換えること。
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes, stripes=16):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripes)]
+        self._stripe_entries = max(1, max_entries // stripes)
+        self._stripe_bytes = max(1, max_bytes // stripes)
+        self._stripe_sizes = [0] * stripes
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def _stripe(self, key):
+        index = hash(key) % len(self._stripes)
+        return index, self._stripes[index][0], self._stripes[index][1]
+
+    def get(self, key, default=None):
+        index, lock, entries = self._stripe(key)
+        with lock:
+            entry = entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value, size = entry
+            if expires_at <= time.monotonic():
+                del entries[key]
+                self._stripe_sizes[index] -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = session_size(value)
+        index, lock, entries = self._stripe(key)
+        with lock:
+            self._put(index, entries, key, value, size)
+
+    def set_if(self, key, value, **expected):
+        """保存中のセッションの各フィールドがexpectedと一致するときだけ置き換え、置き換えたかを返す"""
+        size = session_size(value)
+        index, lock, entries = self._stripe(key)
+        with lock:
+            entry = entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return False
+            if any(entry[1].get(field) != v for field, v in expected.items()):
+                return False
+            self._put(index, entries, key, value, size)
+            return True
+
+    def _put(self, index, entries, key, value, size):
+        old = entries.pop(key, None)
+        if old:
+            self._stripe_sizes[index] -= old[2]
+        entries[key] = (time.monotonic() + self.ttl, value, size)
+        self._stripe_sizes[index] += size
+        while len(entries) > 1 and (len(entries) > self._stripe_entries
+                                    or self._stripe_sizes[index] > self._stripe_bytes):
+            _, (_, _, evicted_size) = entries.popitem(last=False)
+            self._stripe_sizes[index] -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        index, lock, entries = self._stripe(key)
+        with lock:
+            entry = entries.pop(key, None)
+            if entry is None:
+                return default
+            self._stripe_sizes[index] -= entry[2]
+            return entry[1]
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "ttl": self.ttl,
+            "entries": sum(len(entries) for _, entries in self._stripes),
+            "bytes": sum(self._stripe_sizes),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+        }
+
+
+class SQLiteSessionStore:
+    """SQLiteファイルに保存するセッションストア（複数worker・同一ホストのレプリカで会話状態を共有）"""
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        with self._conn() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+
+    def _conn(self):
+        return thread_sqlite_connection(self._local, self.path)
+
+    def get(self, key, default=None):
+        row = self._conn().execute(
+            "SELECT value FROM sessions WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(row["value"])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                         (key, json.dumps(value, ensure_ascii=False, default=str), now + self.ttl))
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                self._last_purge = now
+                self.expirations += conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+
+    def set_if(self, key, value, **expected):
+        """保存中のセッションの各フィールドがexpectedと一致するときだけ置き換え、置き換えたかを返す"""
+        now = time.time()
+        conditions = "".join(" AND json_extract(value, ?) = ?" for _ in expected)
+        params = [param for field, v in expected.items() for param in (f"$.{field}", v)]
+        with self._conn() as conn:
+            cursor = conn.execute(
+                f"UPDATE sessions SET value = ?, expires_at = ? WHERE key = ? AND expires_at > ?{conditions}",
+                [json.dumps(value, ensure_ascii=False, default=str), now + self.ttl, key, now, *params])
+        return cursor.rowcount == 1
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        with self._conn() as conn:
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        return value
+
+    def stats(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(LENGTH(value)), 0) AS bytes FROM sessions").fetchone()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "ttl": self.ttl,
+            "entries": row["entries"],
+            "bytes": row["bytes"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "expirations": self.expirations,
+        }
+
+
+def create_session_store():
+    """SESSION_BACKEND に応じたセッションストアを作成"""
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_TTL)
+    return MemorySessionStore(SESSION_TTL, SESSION_MAX_ENTRIES, SESSION_MAX_BYTES)
+
+
+user_sessions = create_session_store()
+register_stats("sessions", user_sessions.stats)
+
+
 # ═══════════════════════════════════════════
 #  イベントハンドラ
 # ═══════════════════════════════════════════
@@ -1379,80 +3870,114 @@ def handle_join(event):
     ]))
 
 
+MENU_COMMANDS = ("メニュー", "menu", "Menu", "MENU", "めにゅー")
+PROFILE_COMMAND = re.compile(r"プロファイル(?:\s*(\d+))?")
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
     text = event.message.text.strip()
     session_key = get_session_key(event)
-    line_api = get_messaging_api()
-
     session = user_sessions.get(session_key, {})
     state = session.get("state", "idle")
 
-    if text in ["メニュー", "menu", "Menu", "MENU", "めにゅー"]:
+    tracer.annotate(command="other", state=state)
+    with metrics.timed("zenryoku_command", command="other") as labels:
+        def command(name):
+            """メッセージを処理する分岐で呼び、メトリクスとトレースのラベルにするコマンド名を決める
+
+            ユーザー入力をそのままラベルにしないよう固定の名前を渡す（どの分岐にも当たらなければ "other"）。
+            """
+            labels["command"] = name
+            tracer.annotate(command=name)
+
+        process_text_message(event, text, session_key, session, state, command)
+
+
+def process_text_message(event, text, session_key, session, state, command):
+    line_api = get_messaging_api()
+
+    if text in MENU_COMMANDS:
+        command("menu")
         user_sessions.pop(session_key, None)
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_main_menu_flex()]))
         return
 
-    if text == "出勤情報":
+    upcoming_match = re.fullmatch(r"出勤情報(?:\s*(\d{1,2})日?)?", text)
+    if upcoming_match:
+        command("upcoming_shifts")
         user_sessions.pop(session_key, None)
-        shifts = fetch_upcoming_shifts(days=7)
-        line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_upcoming_shifts_flex(shifts)]))
+        days = min(max(int(upcoming_match.group(1) or 7), 1), MAX_UPCOMING_DAYS)
+        shifts = fetch_upcoming_shifts(days=days)
+        line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_upcoming_shifts_flex(shifts, days)]))
         return
 
     if text == "ニュース作成":
-        user_sessions[session_key] = {"state": "news_category_select"}
+        command("news_create")
+        user_sessions.set(session_key, {"state": "news_category_select"})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_news_category_select_flex()]))
         return
 
     if text.startswith("カテゴリ_") and state == "news_category_select":
+        command("news_category")
         category = text.replace("カテゴリ_", "")
-        user_sessions[session_key] = {"state": "news_topic", "category": category}
+        user_sessions.set(session_key, {"state": "news_topic", "category": category})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
             TextMessage(text=f"📰 ニュース作成（カテゴリ: {category}）\n\nニュースのテーマを入力してください。\n（例：新人セラピスト紹介、春のキャンペーン）\n\n「おまかせ」と入力するとAIが自動でテーマを選びます。")
         ]))
         return
 
+    # 生成はバックグラウンドのジョブで行い、完了したら確認Flexをpushする
     if state == "news_topic":
+        command("news_generate")
         topic = None if text in ["おまかせ", "お任せ", "自動"] else text
         category = session.get("category", "その他")
-        user_sessions[session_key] = {"state": "news_generating", "category": category}
+        news_jobs.submit(session_key, get_push_target(event), category, topic)
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text="📝 ニュースを生成中です...\nしばらくお待ちください。")]))
-        news = generate_news(topic)
-        user_sessions[session_key] = {"state": "news_preview", "news": news, "category": category, "topic": topic}
-        push_target = get_push_target(event)
-        if push_target:
-            line_api.push_message(PushMessageRequest(to=push_target, messages=[build_news_confirm_flex(news, category)]))
         return
 
-    if text == "ニュース再生成" and state == "news_preview":
+    # 下書きが残っていればAPIを呼ばずに次の下書きを返す
+    if text == "ニュース再生成" and state == "news_preview" and session.get("drafts"):
+        command("news_regenerate")
+        news, *drafts = session["drafts"]
+        category = session.get("category", "その他")
+        user_sessions.set(session_key, {**session, "news": news, "drafts": drafts})
+        news_draft_stats.hit()
+        line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_news_confirm_flex(news, category)]))
+        return
+
+    # 生成中の再生成は前のジョブを置き換える（前の結果は表示しない）
+    if text == "ニュース再生成" and state in ("news_preview", "news_generating"):
+        command("news_regenerate")
         topic = session.get("topic")
         category = session.get("category", "その他")
-        user_sessions[session_key]["state"] = "news_generating"
+        news_draft_stats.miss()
+        news_jobs.submit(session_key, get_push_target(event), category, topic)
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text="🔄 ニュースを再生成中です...")] ))
-        news = generate_news(topic)
-        user_sessions[session_key] = {"state": "news_preview", "news": news, "category": category, "topic": topic}
-        push_target = get_push_target(event)
-        if push_target:
-            line_api.push_message(PushMessageRequest(to=push_target, messages=[build_news_confirm_flex(news, category)]))
         return
 
     if text == "ニュース保存" and state == "news_preview":
+        command("news_save")
         news = session.get("news", {})
         category = session.get("category", "その他")
         page_id = save_news_to_notion(news.get("title", ""), news.get("body", ""), category)
+        if page_id:
+            news_draft_stats.saved()
         msg = "✅ ニュースを保存しました！" if page_id else "⚠️ 保存に失敗しました。"
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=msg), build_main_menu_flex()]))
         user_sessions.pop(session_key, None)
         return
 
     if text == "ニュース一覧":
-        user_sessions[session_key] = {"state": "news_list"}
+        command("news_list")
         news_list = fetch_news_from_notion(limit=10)
-        user_sessions[session_key]["news_list"] = news_list
+        # 詳細表示で参照するのは一覧に表示する先頭5件だけ
+        user_sessions.set(session_key, {"state": "news_list", "news_list": news_list[:5]})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_news_list_flex(news_list)]))
         return
 
     if text.startswith("ニュース詳細_") and state == "news_list":
+        command("news_detail")
         try:
             index = int(text.replace("ニュース詳細_", ""))
             news_list = session.get("news_list", [])
@@ -1464,13 +3989,14 @@ def handle_text_message(event):
         return
 
     if text == "ニュース配信":
-        user_sessions[session_key] = {"state": "news_delivery"}
+        command("news_delivery")
         news_list = fetch_news_from_notion(limit=10)
-        user_sessions[session_key]["news_list"] = news_list
+        user_sessions.set(session_key, {"state": "news_delivery", "news_list": news_list[:5]})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_news_delivery_select_flex(news_list)]))
         return
 
     if text.startswith("配信実行_") and state == "news_delivery":
+        command("news_broadcast")
         try:
             index = int(text.replace("配信実行_", ""))
             news_list = session.get("news_list", [])
@@ -1485,13 +4011,15 @@ def handle_text_message(event):
 
     # ─── X投稿フロー ───
     if text == "X投稿":
-        user_sessions[session_key] = {"state": "x_post_input"}
+        command("x_post")
+        user_sessions.set(session_key, {"state": "x_post_input"})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
             TextMessage(text="🐦 X（Twitter）投稿\n\n投稿したい内容を入力してください。\n（最大280文字）\n\n「キャンセル」でメニューに戻ります。")
         ]))
         return
 
     if state == "x_post_input":
+        command("x_post_input")
         if text in ["キャンセル", "cancel"]:
             user_sessions.pop(session_key, None)
             line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
@@ -1506,13 +4034,14 @@ def handle_text_message(event):
             ]))
             return
         # 確認フローへ
-        user_sessions[session_key] = {"state": "x_post_confirm", "x_post_text": text}
+        user_sessions.set(session_key, {"state": "x_post_confirm", "x_post_text": text})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
             build_x_post_confirm_flex(text)
         ]))
         return
 
     if text == "X投稿実行" and state == "x_post_confirm":
+        command("x_post_submit")
         post_text = session.get("x_post_text", "")
         if not post_text:
             line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
@@ -1550,6 +4079,7 @@ def handle_text_message(event):
         return
 
     if text == "X投稿キャンセル" and state == "x_post_confirm":
+        command("x_post_cancel")
         user_sessions.pop(session_key, None)
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
             TextMessage(text="X投稿をキャンセルしました。"),
@@ -1558,18 +4088,72 @@ def handle_text_message(event):
         return
 
     if text == "X投稿修正" and state == "x_post_confirm":
-        user_sessions[session_key] = {"state": "x_post_input"}
+        command("x_post_edit")
+        user_sessions.set(session_key, {"state": "x_post_input"})
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
             TextMessage(text="🐦 投稿内容を再入力してください。\n（最大280文字）")
         ]))
         return
 
+    if text == "シフト更新" and event.source.user_id == ADMIN_USER_ID:
+        command("shift_refresh")
+        user_sessions.pop(session_key, None)
+        if shift_mirror and shift_mirror.ready():
+            # ミラーを使っている間はキャッシュを捨ててもミラーの内容が返るため、先にミラーを同期する
+            try:
+                changed = shift_mirror.request_sync()
+            except Exception as e:
+                logger.error(f"Shift mirror sync on request failed: {e}")
+                reply = "⚠️ Notionからの同期に失敗しました。しばらくしてから再度お試しください。"
+            else:
+                if changed is None:
+                    reply = "🔄 Notionからの同期を依頼しました。数秒後の表示から最新データを使用します。"
+                else:
+                    reply = f"🔄 Notionの最新データを取り込みました（{changed}件更新）。"
+            shift_cache.invalidate()
+        else:
+            shift_cache.invalidate()
+            reply = "🔄 シフトのキャッシュを破棄しました。次回の表示からNotionの最新データを使用します。"
+        line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
+            TextMessage(text=reply),
+            build_main_menu_flex()
+        ]))
+        return
+
+    if text == "診断" and event.source.user_id == ADMIN_USER_ID:
+        command("diagnostics")
+        user_sessions.pop(session_key, None)
+        line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[
+            build_diagnostics_flex(collect_diagnostics())
+        ]))
+        return
+
+    profile_match = PROFILE_COMMAND.fullmatch(text)
+    if profile_match and event.source.user_id == ADMIN_USER_ID:
+        command("profile")
+        user_sessions.pop(session_key, None)
+        events = min(max(int(profile_match.group(1) or 20), 1), PROFILE_MAX_EVENTS)
+
+        # 結果のURLはグループに流さず、管理者に個別に送る
+        def notify(filename, summary):
+            get_messaging_api().push_message(PushMessageRequest(
+                to=ADMIN_USER_ID, messages=[build_profile_result_message(filename, summary)]))
+
+        if profiler.start(events, notify):
+            msg = f"🔬 次の{events}件のイベントをプロファイルします。\n完了したら結果のURLをお送りします（最長{PROFILE_MAX_SECONDS / 60:g}分）。"
+        else:
+            msg = "⚠️ プロファイルを実行中です。完了までお待ちください。"
+        line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=msg)]))
+        return
+
     if text == "スケジュール確認":
+        command("schedule_select")
         user_sessions.pop(session_key, None)
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[build_schedule_month_select_flex()]))
         return
 
     if text == "スケジュール_今月":
+        command("schedule")
         user_sessions.pop(session_key, None)
         now = datetime.now()
         line_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=f"📅 {now.year}年{now.month}月のシフトカレンダーを作成中です...")] ))
@@ -1577,6 +4161,7 @@ def handle_text_message(event):
         return
 
     if text == "スケジュール_来月":
+        command("schedule")
         user_sessions.pop(session_key, None)
         now = datetime.now()
         target_year, target_month = (now.year + 1, 1) if now.month == 12 else (now.year, now.month + 1)
@@ -1595,7 +4180,13 @@ def get_push_target(event):
     return source.user_id
 
 
+if WARM_UP:
+    warm_up()
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     logger.info(f"Starting 全力エステ LINE Bot on port {port}")
+    # SIGTERMでもatexitが走るようにし、キュー内のイベントを処理してから終了する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host="0.0.0.0", port=port, debug=False)
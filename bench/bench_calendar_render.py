@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+カレンダー画像描画のベンチマーク
+全描画（use_template=False）とテンプレート方式（use_template=True）の1枚あたりの時間を比較する
+
+    python bench/bench_calendar_render.py [--renders 50]
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import app  # noqa: E402
+import calendar_render  # noqa: E402
+
+
+def sample_cal_data(year, month):
+    """在籍セラピストが毎日2〜5名出勤する月のカレンダーデータ"""
+    therapists = app.SHOP_INFO["therapists"]
+    num_days = app.calendar.monthrange(year, month)[1]
+    return {
+        day: [
+            {"name": therapists[(day + i) % len(therapists)], "condition": "12:00-20:00"}
+            for i in range(2 + day % 4)
+        ]
+        for day in range(1, num_days + 1)
+    }
+
+
+def bench(label, renders, fn):
+    fn()  # ウォームアップ（フォント・テンプレートの読み込み）
+    started = time.perf_counter()
+    for _ in range(renders):
+        fn()
+    per_render_ms = (time.perf_counter() - started) * 1000 / renders
+    print(f"{label:<12} {per_render_ms:8.2f} ms/render")
+    return per_render_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--renders", type=int, default=50)
+    args = parser.parse_args()
+
+    today = date.today()
+    cal_data = sample_cal_data(today.year, today.month)
+
+    full = bench("full", args.renders, lambda: calendar_render.generate_calendar_image(
+        today.year, today.month, cal_data, today=today, use_template=False))
+    templated = bench("template", args.renders, lambda: calendar_render.generate_calendar_image(
+        today.year, today.month, cal_data, today=today, use_template=True))
+    print(f"saving       {full - templated:8.2f} ms/render ({(1 - templated / full) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
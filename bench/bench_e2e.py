@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+オフラインのエンドツーエンド・ベンチマーク
+Notion・LINE・OpenAI・Xのスタンドイン（fake_services.py）にappを向けて起動し、
+各コマンドのフローを署名付きの /callback で最後まで実行して、フローごとのレイテンシとスループットを計測する
+
+    python bench/bench_e2e.py [--flows メニュー,ニュース作成] [--iterations 40] [--concurrency 4]
+                              [--latency notion=120 --latency openai=800] [--server dev|gunicorn]
+
+同期モード（WEBHOOK_ASYNC無効）で起動するため、/callback の応答時間に返信・push・外部API呼び出しが含まれる。
+ニュース生成はバックグラウンドのジョブで行われるため、生成を依頼したステップの後は確認Flexのpushを待つ。
+フローのレイテンシはそのフローの全ステップの合計。
+"""
+
+import sys
+import time
+import argparse
+import statistics
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_server import CHANNEL_SECRET, free_port, start_server
+from fake_services import FakeServices, parse_latency
+from line_events import signed_headers, text_event, webhook_body
+
+FLOWS = {
+    "メニュー": ["メニュー"],
+    "出勤情報": ["出勤情報"],
+    "スケジュール": ["スケジュール確認", "スケジュール_今月"],
+    "ニュース作成": ["ニュース作成", "カテゴリ_お知らせ", "おまかせ", "ニュース保存"],
+    "ニュース一覧": ["ニュース一覧", "ニュース詳細_0"],
+    "ニュース配信": ["ニュース配信", "配信実行_0"],
+    "X投稿": ["X投稿", "ベンチマーク投稿 {n}", "X投稿実行"],
+}
+# ニュース生成はバックグラウンドのジョブで行われるため、確認Flexがpushされるまで次のステップを送らない
+PUSH_STEPS = {"おまかせ", "ニュース再生成"}
+
+
+def run_flow(url, steps, user_id, n, session, services=None):
+    """フローの全ステップを順に送り、合計の所要時間（ms）を返す
+
+    services を渡すと、PUSH_STEPS の後はpushが届くまで待つ（待ち時間もフローの時間に含める）。
+    """
+    started = time.perf_counter()
+    for step in steps:
+        pushes = services.push_count(user_id) if services else 0
+        body = webhook_body([text_event(user_id, step.format(n=n))])
+        resp = session.post(url, data=body.encode("utf-8"), headers=signed_headers(body, CHANNEL_SECRET), timeout=120)
+        resp.raise_for_status()
+        if services and step in PUSH_STEPS:
+            services.wait_for_push(user_id, pushes + 1)
+    return (time.perf_counter() - started) * 1000
+
+
+def bench_flow(port, name, iterations, concurrency, services=None):
+    """(スループット flows/s, 各フローのレイテンシms) を返す"""
+    url = f"http://127.0.0.1:{port}/callback"
+    steps = FLOWS[name]
+
+    def worker(worker_id):
+        session = requests.Session()
+        user_id = f"Ubench{worker_id:04d}"
+        return [run_flow(url, steps, user_id, n, session, services) for n in range(worker_id, iterations, concurrency)]
+
+    run_flow(url, steps, "Ubenchwarmup", 0, requests.Session(), services)  # ウォームアップ（キャッシュ・テンプレート）
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = [ms for result in pool.map(worker, range(concurrency)) for ms in result]
+    return len(latencies) / (time.perf_counter() - started), latencies
+
+
+def pad(text, width):
+    """全角文字を2桁として左寄せする"""
+    display = sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text)
+    return text + " " * max(0, width - display)
+
+
+def percentiles(latencies):
+    if len(latencies) < 2:
+        return latencies * 3
+    q = statistics.quantiles(latencies, n=100)
+    return q[49], q[94], q[98]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flows", default=",".join(FLOWS), help="カンマ区切りのフロー名")
+    parser.add_argument("--iterations", type=int, default=40, help="フローごとの実行回数")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS", help="注入するレイテンシ（例: openai=800）")
+    parser.add_argument("--server", choices=["dev", "gunicorn"], default="dev")
+    parser.add_argument("--workers", type=int, default=2, help="gunicornのworker数")
+    parser.add_argument("--threads", type=int, default=8, help="gunicornのworkerあたりのスレッド数")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.flows.split(",") if name.strip()]
+    unknown = [name for name in names if name not in FLOWS]
+    if unknown:
+        parser.error(f"unknown flow: {', '.join(unknown)} (choices: {', '.join(FLOWS)})")
+
+    services = FakeServices(parse_latency(args.latency)).start()
+    port = free_port()
+    env = {
+        **services.env(),
+        "WEBHOOK_ASYNC": "0",
+        "WEB_CONCURRENCY": str(args.workers),
+        "GUNICORN_THREADS": str(args.threads),
+    }
+    proc = start_server(args.server, port, env)
+    print(f"server={args.server} iterations={args.iterations} concurrency={args.concurrency} "
+          f"latency={', '.join(f'{k}={v:g}ms' for k, v in services.latency_ms.items())}")
+    print(f"{pad('flow', 12)} {'flows/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}   upstream calls/flow")
+    try:
+        for name in names:
+            calls_before = services.snapshot_calls()
+            rps, latencies = bench_flow(port, name, args.iterations, args.concurrency, services)
+            calls = services.snapshot_calls()
+            per_flow = {
+                key: (count - calls_before.get(key, 0)) / (len(latencies) + 1)
+                for key, count in sorted(calls.items()) if count > calls_before.get(key, 0)
+            }
+            p50, p95, p99 = percentiles(latencies)
+            upstream = ", ".join(f"{key}={value:.1f}" for key, value in per_flow.items())
+            print(f"{pad(name, 12)} {rps:8.2f} {p50:9.1f} {p95:9.1f} {p99:9.1f}   {upstream}")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=60)
+        services.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
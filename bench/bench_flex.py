@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Flex Message構築のベンチマーク
+固定メニューを毎回構築・検証する場合（キャッシュなし）と、キャッシュ済みのFlexMessageを使い回す場合で、
+返信1回分（メッセージ構築 + ReplyMessageRequestのJSONシリアライズ）の時間を比較する
+
+    python bench/bench_flex.py [--replies 2000]
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import app  # noqa: E402
+from linebot.v3.messaging import ReplyMessageRequest, TextMessage  # noqa: E402
+
+
+def uncached_builders():
+    """lru_cacheを通さない元の構築関数"""
+    now = datetime.now()
+    return {
+        "main_menu": app.build_main_menu_flex.__wrapped__,
+        "category_select": app.build_news_category_select_flex.__wrapped__,
+        "month_select": lambda: app.build_schedule_month_select_flex_for.__wrapped__(now.year, now.month),
+    }
+
+
+def cached_builders():
+    return {
+        "main_menu": app.build_main_menu_flex,
+        "category_select": app.build_news_category_select_flex,
+        "month_select": app.build_schedule_month_select_flex,
+    }
+
+
+def bench(replies, builder):
+    """テキスト + Flexの返信を組み立ててシリアライズする1回あたりの時間（µs）"""
+    def reply():
+        return ReplyMessageRequest(
+            reply_token="bench", messages=[TextMessage(text="✅ 完了しました"), builder()]).to_json()
+
+    reply()  # ウォームアップ
+    started = time.perf_counter()
+    for _ in range(replies):
+        reply()
+    return (time.perf_counter() - started) * 1_000_000 / replies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", type=int, default=2000)
+    args = parser.parse_args()
+
+    uncached = uncached_builders()
+    cached = cached_builders()
+    print(f"{'message':<16} {'uncached':>10} {'cached':>10}   (µs/reply)")
+    for name in uncached:
+        before = bench(args.replies, uncached[name])
+        after = bench(args.replies, cached[name])
+        print(f"{name:<16} {before:10.1f} {after:10.1f}   ({(1 - after / before) * 100:.0f}% faster)")
+
+
+if __name__ == "__main__":
+    main()
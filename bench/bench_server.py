@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+サーバーのスループットのベンチマーク
+開発サーバー（python app.py）とgunicorn（gunicorn.conf.py）を起動し、
+署名付きの /callback（イベントなし。署名検証とパースのみで外部APIは呼ばない）へ並行してリクエストを送る
+
+    python bench/bench_server.py [--requests 2000] [--concurrency 16] [--server dev|gunicorn|both]
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from line_events import signed_headers, webhook_body
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = "bench-channel-secret"
+BODY = webhook_body([])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, port, extra_env):
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "bench"),
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "SESSION_DB_PATH": os.path.join(tempfile.gettempdir(), f"bench_sessions_{port}.sqlite3"),
+        "METRICS_DIR": os.path.join(tempfile.gettempdir(), f"bench_metrics_{port}"),
+        **extra_env,
+    }
+    if kind == "dev":
+        cmd = [sys.executable, "app.py"]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"]
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{kind} server did not start on port {port}")
+
+
+def run_load(port, total, concurrency):
+    """(スループット req/s, 各リクエストのレイテンシms) を返す"""
+    url = f"http://127.0.0.1:{port}/callback"
+    headers = signed_headers(BODY, CHANNEL_SECRET)
+
+    def worker(n):
+        session = requests.Session()
+        latencies = []
+        for _ in range(n):
+            started = time.perf_counter()
+            resp = session.post(url, data=BODY, headers=headers, timeout=30)
+            resp.raise_for_status()
+            latencies.append((time.perf_counter() - started) * 1000)
+        return latencies
+
+    per_worker = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+    worker(10)  # ウォームアップ
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = [ms for result in pool.map(worker, per_worker) for ms in result]
+    return total / (time.perf_counter() - started), latencies
+
+
+def bench(kind, args):
+    port = free_port()
+    proc = start_server(kind, port, {"WEB_CONCURRENCY": str(args.workers), "GUNICORN_THREADS": str(args.threads)})
+    try:
+        rps, latencies = run_load(port, args.requests, args.concurrency)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=60)
+    q = statistics.quantiles(latencies, n=100)
+    print(f"{kind:<9} {rps:8.0f} req/s   p50 {q[49]:6.1f} ms   p95 {q[94]:6.1f} ms   p99 {q[98]:6.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--server", choices=["dev", "gunicorn", "both"], default="both")
+    parser.add_argument("--workers", type=int, default=2, help="gunicornのworker数（WEB_CONCURRENCY）")
+    parser.add_argument("--threads", type=int, default=8, help="gunicornのworkerあたりのスレッド数")
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}")
+    for kind in (["dev", "gunicorn"] if args.server == "both" else [args.server]):
+        bench(kind, args)
+
+
+if __name__ == "__main__":
+    main()
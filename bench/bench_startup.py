@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+起動時間のベンチマーク
+新しいPythonプロセスで `import app` にかかる時間を `-X importtime` で計測し、
+トップレベルでimportしているモジュールの累積時間が大きい順に表示する
+
+    python bench/bench_startup.py [--runs 5] [--top 10] [--warm-up]
+
+--warm-up を付けると WARM_UP=1（インポート時に重い依存を読み込む）の場合も計測して比較する。
+"""
+
+import os
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def measure(extra_env):
+    """1回分の (import app の累積ms, トップレベルモジュールごとの累積ms) を返す"""
+    env = {**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "bench"), **extra_env}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+    total_ms = None
+    modules = {}
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if not m:
+            continue
+        cumulative_ms = int(m.group(2)) / 1000
+        depth = (len(m.group(3)) - 1) // 2
+        name = m.group(4)
+        if name == "app" and depth == 0:
+            total_ms = cumulative_ms
+        elif depth == 1:
+            modules[name] = cumulative_ms
+    return total_ms, modules
+
+
+def bench(label, runs, top, extra_env):
+    results = [measure(extra_env) for _ in range(runs)]
+    totals = [total for total, _ in results]
+    print(f"{label}: import app median {statistics.median(totals):.0f} ms "
+          f"(min {min(totals):.0f} / max {max(totals):.0f}, {runs} runs)")
+    _, modules = min(results, key=lambda r: r[0])
+    for name, ms in sorted(modules.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        print(f"  {ms:8.1f} ms  {name}")
+    return statistics.median(totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--warm-up", action="store_true", help="WARM_UP=1 の場合も計測する")
+    args = parser.parse_args()
+
+    lazy = bench("lazy (default)", args.runs, args.top, {"WARM_UP": "0"})
+    if args.warm_up:
+        warm = bench("WARM_UP=1", args.runs, args.top, {"WARM_UP": "1"})
+        print(f"deferred to first use: {warm - lazy:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用の外部サービスのスタンドイン（Notion・LINE・OpenAI・X）
+app.pyが使うAPIだけを1つのHTTPサーバーでパスの接頭辞ごとに模倣し、指定したレイテンシを注入する
+
+    /notion/v1  databases/{id}/query, pages, pages/{id}
+    /line       v2/bot/message/reply, push, broadcast
+    /openai/v1  chat/completions
+    /x          2/tweets
+
+単体でも起動できる（表示される環境変数をappに設定する）:
+
+    python bench/fake_services.py --port 9100 --latency notion=120 --latency openai=800
+"""
+
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import calendar
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+THERAPISTS = ["なの", "さな", "しほ", "しいな", "みさき", "らむ", "MOMO", "まりの", "りの"]
+DEFAULT_LATENCY_MS = {"notion": 100, "line": 30, "openai": 500, "x": 150}
+
+
+def shift_page(therapist, day, room):
+    return {
+        "object": "page",
+        "id": str(uuid.uuid4()),
+        "last_edited_time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "properties": {
+            "タイトル": {"title": [{"plain_text": therapist}]},
+            "日付": {"date": {"start": day.isoformat(), "end": None}},
+            "条件": {"rich_text": [{"plain_text": "12:00-20:00"}]},
+            "ルーム": {"select": {"name": room}},
+        },
+    }
+
+
+def news_page(title, body, category, created, delivered=False, page_id=None):
+    return {
+        "object": "page",
+        "id": page_id or str(uuid.uuid4()),
+        "properties": {
+            "タイトル": {"title": [{"plain_text": title}]},
+            "本文": {"rich_text": [{"plain_text": body}]},
+            "カテゴリ": {"select": {"name": category}},
+            "作成日時": {"date": {"start": created}},
+            "配信済み": {"checkbox": delivered},
+        },
+    }
+
+
+def text_of(prop):
+    """Notionのページ作成リクエストのtitle/rich_textから文字列を取り出す"""
+    items = prop.get("title") or prop.get("rich_text") or []
+    return "".join(item.get("text", {}).get("content", "") for item in items)
+
+
+class FakeServices:
+    """Notion・LINE・OpenAI・Xのスタンドインをまとめたローカルサーバー"""
+
+    def __init__(self, latency_ms=None, jitter=0.2, months_ahead=2):
+        self.latency_ms = {**DEFAULT_LATENCY_MS, **(latency_ms or {})}
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.pushes = {}
+        self.shift_pages = self._seed_shifts(months_ahead)
+        self.news_pages = [
+            news_page(f"サンプルニュース{i + 1}", "全力エステからのお知らせです。" * 20, "お知らせ",
+                      (datetime.now() - timedelta(days=i)).isoformat())
+            for i in range(8)
+        ]
+        self.server = None
+
+    @staticmethod
+    def _seed_shifts(months_ahead):
+        """今月から months_ahead か月分、毎日3〜5名が出勤するシフト"""
+        today = date.today()
+        pages = []
+        year, month = today.year, today.month
+        for _ in range(months_ahead):
+            for day_num in range(1, calendar.monthrange(year, month)[1] + 1):
+                day = date(year, month, day_num)
+                for i in range(3 + day_num % 3):
+                    pages.append(shift_page(THERAPISTS[(day_num + i) % len(THERAPISTS)], day, f"ルーム{i + 1}"))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return pages
+
+    def record(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def record_push(self, to):
+        with self._lock:
+            self.pushes[to] = self.pushes.get(to, 0) + 1
+
+    def push_count(self, to):
+        with self._lock:
+            return self.pushes.get(to, 0)
+
+    def wait_for_push(self, to, count, timeout=60):
+        """to 宛てのpushが count 件に達するまで待つ（バックグラウンドで送られるpushの完了待ち）"""
+        deadline = time.monotonic() + timeout
+        while self.push_count(to) < count:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"no push to {to} within {timeout}s")
+            time.sleep(0.01)
+
+    def snapshot_calls(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def delay(self, service):
+        ms = self.latency_ms.get(service, 0)
+        if ms > 0:
+            time.sleep(ms * random.uniform(1 - self.jitter, 1 + self.jitter) / 1000)
+
+    # ─── Notion ───
+
+    def notion_query(self, payload):
+        # ニュースDBは作成日時の降順で、シフトDBは日付フィルター付きで問い合わせられる
+        sorts = payload.get("sorts") or [{}]
+        pages = self._sorted_news() if sorts[0].get("property") == "作成日時" else self._filter_shifts(payload)
+        page_size = min(int(payload.get("page_size", 100)), 100)
+        start = int(payload.get("start_cursor") or 0)
+        results = pages[start:start + page_size]
+        has_more = start + page_size < len(pages)
+        return {"object": "list", "results": results, "has_more": has_more,
+                "next_cursor": str(start + page_size) if has_more else None}
+
+    def _sorted_news(self):
+        with self._lock:
+            return sorted(self.news_pages, key=lambda p: p["properties"]["作成日時"]["date"]["start"], reverse=True)
+
+    def _filter_shifts(self, payload):
+        after, before = None, None
+        for condition in payload.get("filter", {}).get("and", []):
+            date_filter = condition.get("date", {})
+            after = date_filter.get("on_or_after", after)
+            before = date_filter.get("on_or_before", before)
+        return [
+            p for p in self.shift_pages
+            if (after is None or p["properties"]["日付"]["date"]["start"] >= after)
+            and (before is None or p["properties"]["日付"]["date"]["start"] <= before)
+        ]
+
+    def notion_create_page(self, payload):
+        props = payload.get("properties", {})
+        page = news_page(text_of(props.get("タイトル", {})), text_of(props.get("本文", {})),
+                         props.get("カテゴリ", {}).get("select", {}).get("name", ""), datetime.now().isoformat())
+        with self._lock:
+            self.news_pages.append(page)
+        return page
+
+    def notion_update_page(self, page_id, payload):
+        with self._lock:
+            for page in self.news_pages:
+                if page["id"] == page_id and "配信済み" in payload.get("properties", {}):
+                    page["properties"]["配信済み"] = payload["properties"]["配信済み"]
+                    return page
+        return {"object": "page", "id": page_id}
+
+    # ─── OpenAI ───
+
+    @staticmethod
+    def chat_completion(payload):
+        n = int(payload.get("n") or 1)
+        choices = [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": json.dumps(
+                    {"title": f"全力エステの新しいお知らせ{i + 1}", "body": "仙台の全力エステから特別なご案内です。" * 40},
+                    ensure_ascii=False)},
+                "finish_reason": "stop",
+            }
+            for i in range(n)
+        ]
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-4.1-mini"),
+            "choices": choices,
+            "usage": {"prompt_tokens": 350, "completion_tokens": 900 * n, "total_tokens": 350 + 900 * n},
+        }
+
+    # ─── サーバー ───
+
+    def route(self, method, path, payload):
+        """(サービス名, 呼び出し名, ステータス, レスポンス) を返す"""
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["notion", "v1"]:
+            rest = parts[2:]
+            if method == "POST" and len(rest) == 3 and rest[0] == "databases" and rest[2] == "query":
+                return "notion", "notion.query", 200, self.notion_query(payload)
+            if method == "POST" and rest == ["pages"]:
+                return "notion", "notion.create_page", 200, self.notion_create_page(payload)
+            if method == "PATCH" and len(rest) == 2 and rest[0] == "pages":
+                return "notion", "notion.update_page", 200, self.notion_update_page(rest[1], payload)
+        elif parts[:1] == ["line"]:
+            endpoint = parts[-1]
+            if method == "POST" and endpoint in ("reply", "push"):
+                if endpoint == "push":
+                    self.record_push(payload.get("to"))
+                sent = [{"id": str(uuid.uuid4().int)[:18], "quoteToken": uuid.uuid4().hex}
+                        for _ in payload.get("messages", [])]
+                return "line", f"line.{endpoint}", 200, {"sentMessages": sent}
+            if method == "POST" and endpoint == "broadcast":
+                return "line", "line.broadcast", 200, {}
+        elif parts[:2] == ["openai", "v1"] and parts[2:] == ["chat", "completions"]:
+            return "openai", "openai.chat", 200, self.chat_completion(payload)
+        elif parts[:1] == ["x"] and parts[1:] == ["2", "tweets"] and method == "POST":
+            return "x", "x.tweet", 201, {"data": {"id": str(uuid.uuid4().int)[:19], "text": payload.get("text", "")}}
+        return None, "unknown", 404, {"message": f"not found: {method} {path}"}
+
+    def start(self, host="127.0.0.1", port=0):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                payload = json.loads(raw) if raw else {}
+                service, name, status, body = services.route(self.command, self.path.split("?")[0], payload)
+                services.record(name)
+                if service:
+                    services.delay(service)
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_POST = _handle
+            do_PATCH = _handle
+            do_GET = _handle
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def env(self):
+        """appをスタンドインに向けるための環境変数"""
+        base = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+        return {
+            "NOTION_API_KEY": "fake-notion-key",
+            "NOTION_API_BASE_URL": f"{base}/notion/v1",
+            "LINE_API_BASE_URL": f"{base}/line",
+            "OPENAI_API_KEY": "fake-openai-key",
+            "OPENAI_BASE_URL": f"{base}/openai/v1",
+            "X_API_BASE_URL": f"{base}/x",
+            "X_API_KEY": "fake",
+            "X_API_KEY_SECRET": "fake",
+            "X_ACCESS_TOKEN": "fake",
+            "X_ACCESS_TOKEN_SECRET": "fake",
+        }
+
+
+def parse_latency(values):
+    """["notion=120", "openai=800"] → {"notion": 120.0, "openai": 800.0}"""
+    latency = {}
+    for value in values or []:
+        service, _, ms = value.partition("=")
+        if service not in DEFAULT_LATENCY_MS or not ms:
+            raise argparse.ArgumentTypeError(f"invalid --latency {value!r} (service=ms, service: {', '.join(DEFAULT_LATENCY_MS)})")
+        latency[service] = float(ms)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS",
+                        help=f"注入するレイテンシ（既定: {', '.join(f'{k}={v}' for k, v in DEFAULT_LATENCY_MS.items())}）")
+    args = parser.parse_args()
+
+    services = FakeServices(parse_latency(args.latency)).start(args.host, args.port)
+    for key, value in services.env().items():
+        print(f"{key}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        services.stop()
+
+
+if __name__ == "__main__":
+    main()
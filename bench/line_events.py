@@ -0,0 +1,74 @@
+"""
+ベンチマーク用のLINE Webhookリクエスト（イベントJSONと署名）の組み立て
+"""
+
+import hmac
+import json
+import time
+import uuid
+import base64
+import hashlib
+
+
+def user_source(user_id):
+    return {"type": "user", "userId": user_id}
+
+
+def group_source(group_id, user_id=None):
+    source = {"type": "group", "groupId": group_id}
+    if user_id:
+        source["userId"] = user_id
+    return source
+
+
+def room_source(room_id, user_id=None):
+    source = {"type": "room", "roomId": room_id}
+    if user_id:
+        source["userId"] = user_id
+    return source
+
+
+def base_event(event_type, source):
+    """全イベント共通のフィールド（返信可能なイベントとしてreplyTokenを含む）"""
+    return {
+        "type": event_type,
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": source,
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+    }
+
+
+def text_event(user_id, text, source=None):
+    """テキストメッセージイベント（sourceを省略すると1:1トーク）"""
+    event = base_event("message", source or user_source(user_id))
+    event["message"] = {"type": "text", "id": str(uuid.uuid4().int)[:18], "quoteToken": uuid.uuid4().hex, "text": text}
+    return event
+
+
+def follow_event(user_id):
+    """友だち追加イベント"""
+    event = base_event("follow", user_source(user_id))
+    event["follow"] = {"isUnblocked": False}
+    return event
+
+
+def join_event(source):
+    """グループ・トークルームへの参加イベント"""
+    return base_event("join", source)
+
+
+def webhook_body(events, destination="Ubench"):
+    return json.dumps({"destination": destination, "events": events}, ensure_ascii=False)
+
+
+def signature(body, channel_secret):
+    """X-Line-Signature ヘッダーの値"""
+    digest = hmac.new(channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def signed_headers(body, channel_secret):
+    return {"Content-Type": "application/json", "X-Line-Signature": signature(body, channel_secret)}
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+署名付きLINE Webhookの負荷生成ツール
+多数のユーザー・グループ・トークルームからのイベント（友だち追加・参加・テキストメッセージ）を合成し、
+CHANNEL_SECRETで署名して /callback へ指定レートで送り、達成RPS・エラー率・レイテンシ分布を表示する。
+テキストメッセージは各送信元ごとにコマンドのフロー（bench_e2e.pyのFLOWS）を順に進める。
+
+    # fake_services.py に向けたappを起動して、レートを段階的に上げる
+    python bench/loadgen.py --rate 10,20,40,80 --duration 15 --concurrency 32 --server gunicorn
+
+    # 起動済みのサーバーに送る（署名用のチャネルシークレットを指定）
+    python bench/loadgen.py --url http://127.0.0.1:5000/callback --secret $LINE_CHANNEL_SECRET --rate 50
+
+レイテンシは予定送信時刻から計測する（サーバーが詰まって送信が遅れた分も含む）。
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import statistics
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+from bench_e2e import FLOWS
+from bench_server import CHANNEL_SECRET, free_port, start_server
+from fake_services import FakeServices, parse_latency
+from line_events import (
+    follow_event, group_source, join_event, room_source, signed_headers, text_event, user_source, webhook_body,
+)
+
+
+class Actor:
+    """1つの送信元（1:1トークのユーザー、またはグループ・トークルーム内のユーザー）"""
+
+    def __init__(self, user_id, source):
+        self.user_id = user_id
+        self.source = source
+        self.steps = []
+        self.sent = 0
+
+    def next_text(self, rng):
+        if not self.steps:
+            self.steps = list(FLOWS[rng.choice(list(FLOWS))])
+        self.sent += 1
+        return self.steps.pop(0).format(n=self.sent)
+
+
+class Population:
+    """送信元の集合。同じ送信元のイベントが同時に処理中にならないよう、空いている送信元から選ぶ"""
+
+    def __init__(self, users, groups, rooms, seed=None):
+        self.rng = random.Random(seed)
+        actors = [Actor(f"Uload{i:05d}", user_source(f"Uload{i:05d}")) for i in range(users)]
+        for i in range(groups):
+            member = f"Uload{self.rng.randrange(max(users, 1)):05d}"
+            actors.append(Actor(member, group_source(f"Cload{i:05d}", member)))
+        for i in range(rooms):
+            member = f"Uload{self.rng.randrange(max(users, 1)):05d}"
+            actors.append(Actor(member, room_source(f"Rload{i:05d}", member)))
+        self.rng.shuffle(actors)
+        self._idle = deque(actors)
+        self._actors = actors
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.popleft()
+            return self.rng.choice(self._actors)
+
+    def release(self, actor):
+        with self._lock:
+            if actor not in self._idle:
+                self._idle.append(actor)
+
+    def make_event(self, actor, kind):
+        if kind == "follow":
+            return follow_event(actor.user_id)
+        if kind == "join" and actor.source["type"] != "user":
+            return join_event({k: v for k, v in actor.source.items() if k != "userId"})
+        with self._lock:
+            text = actor.next_text(self.rng)
+        return text_event(actor.user_id, text, source=actor.source)
+
+
+def parse_mix(value):
+    """"text=8,follow=1,join=1" → (["text", "follow", "join"], [8, 1, 1])"""
+    kinds, weights = [], []
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("text", "follow", "join"):
+            raise argparse.ArgumentTypeError(f"unknown event type in --mix: {kind!r}")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def run_step(url, secret, population, mix, rate, duration, concurrency, events_per_body, timeout):
+    """一定レートで duration 秒送信し、結果の集計を返す"""
+    kinds, weights = mix
+    local = threading.local()
+    results = []
+    results_lock = threading.Lock()
+
+    def send(scheduled):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        actors = [population.acquire() for _ in range(events_per_body)]
+        events = [population.make_event(actor, random.choices(kinds, weights)[0]) for actor in actors]
+        body = webhook_body(events)
+        sent_at = time.perf_counter()
+        error = None
+        try:
+            resp = session.post(url, data=body.encode("utf-8"), headers=signed_headers(body, secret), timeout=timeout)
+            if resp.status_code != 200:
+                error = f"HTTP {resp.status_code}"
+        except requests.RequestException as e:
+            error = type(e).__name__
+        finished = time.perf_counter()
+        for actor in actors:
+            population.release(actor)
+        with results_lock:
+            results.append(((finished - scheduled) * 1000, (finished - sent_at) * 1000, finished, error))
+
+    total = max(1, int(rate * duration))
+    interval = 1.0 / rate
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        futures = []
+        for i in range(total):
+            scheduled = started + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, scheduled))
+        wait(futures)
+
+    latencies = sorted(r[0] for r in results)
+    service = sorted(r[1] for r in results)
+    errors = Counter(r[3] for r in results if r[3])
+    elapsed = max(r[2] for r in results) - started
+    q = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "target_rps": rate,
+        "sent": len(results),
+        "achieved_rps": len(results) / elapsed,
+        "error_rate": sum(errors.values()) / len(results),
+        "errors": dict(errors),
+        "p50": q[49], "p90": q[89], "p99": q[98], "max": latencies[-1],
+        "service_p50": statistics.median(service),
+    }
+
+
+def is_saturated(result):
+    """目標レートに届かない、エラーが出る、またはキュー待ちでレイテンシが伸び始めたら飽和とみなす"""
+    return (result["achieved_rps"] < result["target_rps"] * 0.95
+            or result["error_rate"] > 0.01
+            or result["p99"] > max(1000.0, result["service_p50"] * 10))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="送信先の /callback（省略時はスタンドインに向けたappを起動する）")
+    parser.add_argument("--secret", default=os.environ.get("LINE_CHANNEL_SECRET"), help="署名に使うチャネルシークレット（--url 指定時）")
+    parser.add_argument("--rate", default="20", help="送信レート（リクエスト/秒）。カンマ区切りで段階的に上げる")
+    parser.add_argument("--duration", type=float, default=10, help="各レートで送信する秒数")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に処理中にできるリクエスト数の上限")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=8,follow=1,join=1"),
+                        help="イベント種別の比率（既定: text=8,follow=1,join=1）")
+    parser.add_argument("--events-per-body", type=int, default=1, help="1リクエストに含めるイベント数")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--server", choices=["dev", "gunicorn"], default="dev", help="起動するサーバー（--url 未指定時）")
+    parser.add_argument("--workers", type=int, default=2, help="gunicornのworker数")
+    parser.add_argument("--threads", type=int, default=8, help="gunicornのworkerあたりのスレッド数")
+    parser.add_argument("--async", dest="webhook_async", action="store_true", help="起動するappをWEBHOOK_ASYNC=1にする")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS", help="スタンドインのレイテンシ（例: openai=800）")
+    args = parser.parse_args()
+
+    rates = [float(r) for r in args.rate.split(",") if r.strip()]
+    population = Population(args.users, args.groups, args.rooms, seed=args.seed)
+
+    services = proc = None
+    url, secret = args.url, args.secret
+    if not url:
+        services = FakeServices(parse_latency(args.latency)).start()
+        port = free_port()
+        proc = start_server(args.server, port, {
+            **services.env(),
+            "WEBHOOK_ASYNC": "1" if args.webhook_async else "0",
+            "WEB_CONCURRENCY": str(args.workers),
+            "GUNICORN_THREADS": str(args.threads),
+        })
+        url, secret = f"http://127.0.0.1:{port}/callback", CHANNEL_SECRET
+    elif not secret:
+        parser.error("--secret (or LINE_CHANNEL_SECRET) is required with --url")
+
+    print(f"target={url} actors={args.users}+{args.groups}g+{args.rooms}r concurrency={args.concurrency} "
+          f"events/body={args.events_per_body} duration={args.duration:g}s")
+    print(f"{'target':>7} {'achieved':>9} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    saturation = None
+    try:
+        for rate in rates:
+            result = run_step(url, secret, population, args.mix, rate, args.duration,
+                              args.concurrency, args.events_per_body, args.timeout)
+            saturated = is_saturated(result)
+            print(f"{rate:7.1f} {result['achieved_rps']:9.1f} {result['error_rate'] * 100:6.1f}% "
+                  f"{result['p50']:8.1f} {result['p90']:8.1f} {result['p99']:8.1f} {result['max']:8.1f}"
+                  f"{'  saturated' if saturated else ''}")
+            if result["errors"]:
+                print(f"        errors: {', '.join(f'{k}={v}' for k, v in result['errors'].items())}")
+            if saturated and saturation is None:
+                saturation = rate
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=60)
+        if services:
+            services.stop()
+
+    if len(rates) > 1:
+        below = [r for r in rates if saturation is None or r < saturation]
+        if saturation is None:
+            print(f"not saturated up to {rates[-1]:g} req/s")
+        else:
+            print(f"saturated at {saturation:g} req/s (last sustained: {below[-1]:g} req/s)" if below
+                  else f"saturated at {saturation:g} req/s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""
+カレンダー画像の描画（フォント・月ごとのテンプレート・エンコード）
+
+app.pyから切り出した副作用のないモジュール。CalendarRenderPoolのspawnワーカーはこのモジュールだけを
+importするため、ワーカーごとにapp.py（環境変数の検証・WARM_UP・クライアント作成など）が読み込まれることはない。
+app.pyに依存するimportをここに追加しないこと。
+"""
+
+import io
+import os
+import time
+import logging
+import calendar
+import functools
+import threading
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# ─── セラピスト色分け ───
+THERAPIST_COLORS = [
+    "#FF6B9D",  # ピンク
+    "#C084FC",  # パープル
+    "#60A5FA",  # ブルー
+    "#34D399",  # グリーン
+    "#FBBF24",  # イエロー
+    "#FB923C",  # オレンジ
+    "#F87171",  # レッド
+    "#A78BFA",  # バイオレット
+    "#2DD4BF",  # ティール
+    "#E879F9",  # マゼンタ
+    "#FCA5A5",  # ライトレッド
+    "#86EFAC",  # ライトグリーン
+    "#93C5FD",  # ライトブルー
+    "#FDE68A",  # ライトイエロー
+    "#FDBA74",  # ライトオレンジ
+]
+
+# ─── カレンダー画像テーマ ───
+CALENDAR_THEMES = {
+    "dark": {
+        "bg": "#1a1a2e",
+        "cell_bg": "#16213e",
+        "cell_border": "#0f3460",
+        "today_bg": "#e94560",
+        "today_border": "#ff6b6b",
+        "text": "#ffffff",
+        "text_sub": "#a0a0a0",
+        "saturday": "#60A5FA",
+        "sunday": "#F87171",
+        "header_bg": "#0f3460",
+        "title": "#f0e6d3",
+    },
+}
+
+
+# フォント候補（先頭から順に存在するものを使用）
+FONT_CANDIDATES = {
+    "bold": [
+        "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+        "/usr/share/fonts/truetype/noto/NotoSansCJK-Bold.ttc",
+        "/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc",
+        "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Bold.ttc",
+        "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    ],
+    "regular": [
+        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    ],
+}
+
+# カレンダー画像で使う (書体, サイズ) の組み合わせ
+CALENDAR_FONT_SPECS = [("bold", 36), ("bold", 20), ("bold", 18), ("regular", 13), ("regular", 14)]
+
+
+class FontRegistry:
+    """フォントのパス解決と読み込みをプロセス全体で1回ずつ行い、描画間・スレッド間で共有する"""
+
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self._paths = None
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def paths(self):
+        """書体ごとに見つかったフォントファイルのパス（見つからなければNone）"""
+        if self._paths is None:
+            self._paths = {
+                role: next((p for p in paths if os.path.exists(p)), None)
+                for role, paths in self.candidates.items()
+            }
+        return self._paths
+
+    def get(self, role, size):
+        font = self._fonts.get((role, size))
+        if font is not None:
+            return font
+        with self._lock:
+            font = self._fonts.get((role, size))
+            if font is None:
+                from PIL import ImageFont
+                path = self.paths().get(role)
+                try:
+                    if not path:
+                        raise FileNotFoundError(f"No suitable {role} font found")
+                    font = ImageFont.truetype(path, size)
+                except Exception as e:
+                    logger.warning(f"Font loading error: {e}, using default")
+                    font = ImageFont.load_default()
+                self._fonts[(role, size)] = font
+        return font
+
+    def preload(self, specs):
+        """指定した (書体, サイズ) をまとめて読み込み、解決結果と所要時間をログに出す"""
+        started = time.perf_counter()
+        for role, size in specs:
+            self.get(role, size)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        resolved = ", ".join(f"{role}={path or 'default'}" for role, path in self.paths().items())
+        logger.info(f"Fonts loaded in {elapsed_ms:.0f}ms ({len(specs)} faces): {resolved}")
+
+
+fonts = FontRegistry(FONT_CANDIDATES)
+
+
+# カレンダー画像のレイアウト（px）
+CAL_CELL_W = 150
+CAL_CELL_H = 110
+CAL_HEADER_H = 80
+CAL_DAY_HEADER_H = 35
+CAL_PADDING = 15
+CAL_LEGEND_COLS = 5
+
+
+def calendar_month_shape(year, month):
+    """(日曜始まりの1日の列, 日数, 行数) を返す"""
+    first_weekday, num_days = calendar.monthrange(year, month)
+    first_weekday_sun = (first_weekday + 1) % 7
+    num_rows = (first_weekday_sun + num_days + 6) // 7
+    return first_weekday_sun, num_days, num_rows
+
+
+def calendar_cell_origin(first_weekday_sun, day_num):
+    """日付セルの左上座標"""
+    cell_index = first_weekday_sun + day_num - 1
+    x = CAL_PADDING + (cell_index % 7) * CAL_CELL_W
+    y = CAL_HEADER_H + CAL_DAY_HEADER_H + (cell_index // 7) * CAL_CELL_H
+    return x, y
+
+
+def draw_calendar_cell(draw, x, y, day_num, fill, outline, colors):
+    """日付セルの枠と日付（中央揃え）を描画"""
+    draw.rectangle([x, y, x + CAL_CELL_W - 1, y + CAL_CELL_H - 1], fill=fill, outline=outline, width=2)
+    day_str = str(day_num)
+    font_day_num = fonts.get("bold", 18)
+    bbox = draw.textbbox((0, 0), day_str, font=font_day_num)
+    tw = bbox[2] - bbox[0]
+    draw.text((x + (CAL_CELL_W - tw) // 2, y + 5), day_str, fill=colors["text"], font=font_day_num)
+
+
+def draw_calendar_static(draw, year, month, img_w, colors):
+    """月ごとに変わらない部分（ヘッダー・曜日・セル枠・日付・凡例見出し）を描画"""
+    font_title = fonts.get("bold", 36)
+    font_day_header = fonts.get("bold", 20)
+    font_legend = fonts.get("regular", 14)
+    first_weekday_sun, num_days, num_rows = calendar_month_shape(year, month)
+
+    draw.rectangle([0, 0, img_w, CAL_HEADER_H], fill=colors["header_bg"])
+
+    title_text = f"{year}年{month}月 シフトカレンダー"
+    bbox = draw.textbbox((0, 0), title_text, font=font_title)
+    tw = bbox[2] - bbox[0]
+    draw.text(((img_w - tw) // 2, 20), title_text, fill=colors["title"], font=font_title)
+
+    weekdays = ["日", "月", "火", "水", "木", "金", "土"]
+    for i, wd in enumerate(weekdays):
+        x = CAL_PADDING + i * CAL_CELL_W
+        color = colors["sunday"] if i == 0 else (colors["saturday"] if i == 6 else colors["text"])
+        bbox = draw.textbbox((0, 0), wd, font=font_day_header)
+        tw = bbox[2] - bbox[0]
+        draw.text((x + (CAL_CELL_W - tw) // 2, CAL_HEADER_H + 7), wd, fill=color, font=font_day_header)
+
+    for day_num in range(1, num_days + 1):
+        x, y = calendar_cell_origin(first_weekday_sun, day_num)
+        draw_calendar_cell(draw, x, y, day_num, colors["cell_bg"], colors["cell_border"], colors)
+
+    legend_y = CAL_HEADER_H + CAL_DAY_HEADER_H + num_rows * CAL_CELL_H + 10
+    draw.text((CAL_PADDING, legend_y), "セラピスト凡例:", fill=colors["text"], font=font_legend)
+
+
+@functools.lru_cache(maxsize=32)
+def get_calendar_template(year, month, theme, img_h):
+    """静的部分を描画済みのテンプレート画像（呼び出し側はcopy()して使い、直接描き込まないこと）"""
+    from PIL import Image, ImageDraw
+    img_w = CAL_CELL_W * 7 + CAL_PADDING * 2
+    img = Image.new("RGB", (img_w, img_h), CALENDAR_THEMES[theme]["bg"])
+    draw_calendar_static(ImageDraw.Draw(img), year, month, img_w, CALENDAR_THEMES[theme])
+    return img
+
+
+def generate_calendar_image(year, month, cal_data, today=None, theme="dark", use_template=True):
+    """Pillowでカレンダー画像を生成（デフォルトはダークテーマ）
+
+    use_template=True なら月ごとにキャッシュしたテンプレートをコピーし、
+    シフト名・人数超過・当日ハイライト・凡例だけを描画する。
+    """
+    from PIL import Image, ImageDraw
+
+    font_name = fonts.get("regular", 13)
+    font_legend = fonts.get("regular", 14)
+    colors = CALENDAR_THEMES[theme]
+    text_white = colors["text"]
+    text_gray = colors["text_sub"]
+
+    first_weekday_sun, num_days, num_rows = calendar_month_shape(year, month)
+
+    all_therapists = set()
+    for day_shifts in cal_data.values():
+        for s in day_shifts:
+            all_therapists.add(s["name"])
+    therapist_list = sorted(all_therapists)
+    therapist_color_map = {}
+    for i, name in enumerate(therapist_list):
+        therapist_color_map[name] = THERAPIST_COLORS[i % len(THERAPIST_COLORS)]
+
+    legend_h = max(60, 30 + ((len(therapist_list) + CAL_LEGEND_COLS - 1) // CAL_LEGEND_COLS) * 28)
+    img_w = CAL_CELL_W * 7 + CAL_PADDING * 2
+    img_h = CAL_HEADER_H + CAL_DAY_HEADER_H + CAL_CELL_H * num_rows + legend_h + CAL_PADDING * 2
+
+    if use_template:
+        img = get_calendar_template(year, month, theme, img_h).copy()
+        draw = ImageDraw.Draw(img)
+    else:
+        img = Image.new("RGB", (img_w, img_h), colors["bg"])
+        draw = ImageDraw.Draw(img)
+        draw_calendar_static(draw, year, month, img_w, colors)
+
+    today_val = today or date.today()
+    if (today_val.year, today_val.month) == (year, month):
+        x, y = calendar_cell_origin(first_weekday_sun, today_val.day)
+        draw_calendar_cell(draw, x, y, today_val.day, colors["today_bg"], colors["today_border"], colors)
+
+    for day_num in range(1, num_days + 1):
+        shifts = cal_data.get(day_num, [])
+        if not shifts:
+            continue
+        x, y = calendar_cell_origin(first_weekday_sun, day_num)
+        name_y = y + 30
+        for shift in shifts[:3]:
+            name = shift["name"]
+            condition = shift["condition"]
+            color = therapist_color_map.get(name, text_white)
+            text = f"{name} {condition}"
+            draw.text((x + 5, name_y), text, fill=color, font=font_name)
+            name_y += 18
+
+        if len(shifts) > 3:
+            draw.text((x + 5, name_y), f"+{len(shifts) - 3}名", fill=text_gray, font=font_name)
+
+    legend_y = CAL_HEADER_H + CAL_DAY_HEADER_H + num_rows * CAL_CELL_H + 10 + 25
+    for i, name in enumerate(therapist_list):
+        col = i % CAL_LEGEND_COLS
+        row = i // CAL_LEGEND_COLS
+        x = CAL_PADDING + col * (img_w // CAL_LEGEND_COLS)
+        y = legend_y + row * 28
+        color = therapist_color_map[name]
+        draw.rectangle([x, y, x + 15, y + 15], fill=color)
+        draw.text((x + 20, y), name, fill=text_white, font=font_legend)
+
+    return img
+
+
+def encode_calendar_image(img, fmt):
+    """カレンダー画像を指定形式でエンコードする
+
+    png8: ダークテーマは使用色が少ないため256色パレットに減色して最適化（既定）
+    png:  フルカラーPNG
+    jpeg: JPEG（LINEの画像メッセージはJPEG/PNGのみ対応のためWebPは扱わない）
+    """
+    from PIL import Image
+
+    buf = io.BytesIO()
+    if fmt == "png8":
+        img.quantize(colors=256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE).save(buf, "PNG", optimize=True)
+    elif fmt == "jpeg":
+        img.save(buf, "JPEG", quality=85, optimize=True, progressive=True)
+    else:
+        img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def encode_calendar_preview(img, width):
+    """トーク画面のサムネイル用に縮小したJPEG"""
+    from PIL import Image
+
+    height = round(img.height * width / img.width)
+    buf = io.BytesIO()
+    img.resize((width, height), Image.LANCZOS).save(buf, "JPEG", quality=80, optimize=True)
+    return buf.getvalue()
+
+
+def render_calendar_images(year, month, cal_data, today, theme, fmt, preview_width):
+    """カレンダー画像を描画し (原寸画像, プレビュー画像, 工程ごとの所要時間ms) を返す（プロセスプールのワーカーでも実行される）
+
+    ワーカープロセスで記録したメトリクスは親から見えないため、所要時間は戻り値で返して呼び出し元で記録する。
+    """
+    timings = {}
+    started = time.perf_counter()
+    img = generate_calendar_image(year, month, cal_data, today=today, theme=theme)
+    timings["calendar.generate"] = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    original = encode_calendar_image(img, fmt)
+    timings["calendar.encode"] = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    preview = encode_calendar_preview(img, preview_width)
+    timings["calendar.preview"] = (time.perf_counter() - started) * 1000
+    return original, preview, timings
+
+
+def init_render_worker():
+    """描画ワーカープロセスの初期化（フォントを読み込んだ状態で待機させる）"""
+    fonts.preload(CALENDAR_FONT_SPECS)
@@ -0,0 +1,56 @@
+"""
+本番用のgunicorn設定
+
+    gunicorn -c gunicorn.conf.py app:app
+
+- preload_app: 親プロセスでappをimportしてWARM_UP（OpenAI・tweepy・Pillow・フォント）を済ませ、
+  workerはfork後にそれを共有する。接続プールやスレッドはfork後に各workerで作り直される
+- worker入れ替え: `kill -HUP <master pid>` で新しいworkerを起動してから古いworkerを止める。
+  古いworkerは処理中のリクエストを終え、worker_exitでキュー内のWebhookイベントを処理し切ってから終了する。
+  preload_appが有効な間は新しいworkerも親プロセスが読み込み済みのappからforkされるため、HUPでは新しいコードは読み込まれない
+- デプロイ（コードの更新）: `kill -USR2 <master pid>` で新しいmasterを起動し、新しいworkerが立ち上がったら
+  古いmasterに `kill -TERM` を送る（または再起動する）。HUPで再読み込みしたい場合は GUNICORN_PRELOAD=0 にする
+"""
+
+import os
+import glob
+
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "2"))
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", "8"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "25"))
+
+# app.pyのimport前に設定する（preload時は親プロセスで1回だけ読み込まれる）
+os.environ.setdefault("WARM_UP", "1")
+if WEB_CONCURRENCY > 1:
+    # メモリ上のセッションはworkerごとに分かれてしまうため、複数workerではSQLiteで共有する
+    os.environ.setdefault("SESSION_BACKEND", "sqlite")
+    # /metrics をどのworkerが受けても全worker分を返せるよう、各workerの値をファイルで共有する
+    os.environ.setdefault("METRICS_DIR", "data/metrics")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = WEB_CONCURRENCY
+worker_class = "gthread"
+threads = GUNICORN_THREADS
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1").lower() in ("1", "true", "yes")
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+# 処理中のリクエストとキュー内イベント・ニュース生成ジョブの処理を待つ時間（WEBHOOK_DRAIN_TIMEOUTより長くする）
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", str(int(WEBHOOK_DRAIN_TIMEOUT) + 5)))
+keepalive = 5
+
+
+def on_starting(server):
+    """前回起動時のworkerが残したメトリクスを消してから起動する（graceful reloadでは呼ばれず値が引き継がれる）"""
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if metrics_dir:
+        for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+            os.remove(path)
+
+
+def worker_exit(server, worker):
+    """worker終了時（再起動・graceful reload・SIGTERM）にキュー内のWebhookイベントとニュース生成ジョブを処理し切る"""
+    from app import drain_background_work, metrics
+    try:
+        # イベントとジョブの待ちは合わせてWEBHOOK_DRAIN_TIMEOUT以内に収まる
+        drain_background_work()
+    finally:
+        metrics.flush()
@@ -0,0 +1,34 @@
+"""セッションストアのテスト"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import app  # noqa: E402
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return app.SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), ttl=60)
+    return app.MemorySessionStore(ttl=60, max_entries=100, max_bytes=1024 * 1024)
+
+
+def test_set_if_replaces_only_when_fields_match(store):
+    store.set("k", {"state": "news_generating", "job_id": "B"})
+
+    # 古いジョブAの結果は、新しいジョブBの生成中状態を上書きしない
+    assert not store.set_if("k", {"state": "news_preview", "job_id": "A"}, state="news_generating", job_id="A")
+    assert store.get("k") == {"state": "news_generating", "job_id": "B"}
+
+    assert store.set_if("k", {"state": "news_preview", "job_id": "B"}, state="news_generating", job_id="B")
+    assert store.get("k") == {"state": "news_preview", "job_id": "B"}
+
+
+def test_set_if_does_not_create_missing_session(store):
+    assert not store.set_if("missing", {"state": "news_preview"}, job_id="A")
+    assert store.get("missing") is None
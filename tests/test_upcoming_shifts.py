@@ -0,0 +1,80 @@
+"""出勤情報（「出勤情報 N」）のテスト"""
+
+import os
+import sys
+import json
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import app  # noqa: E402
+
+# LINEのバブル1つあたりのJSONの上限
+LINE_BUBBLE_MAX_BYTES = 30 * 1000
+
+
+def make_shifts(days, per_day, start=date(2026, 1, 1)):
+    """長めの名前・条件・ルームのシフトを1日per_day件ずつ並べる"""
+    return [
+        {
+            "date": (start + timedelta(days=d)).isoformat(),
+            "name": f"セラピスト名前長め{i:02d}",
+            "condition": "12:00〜翌5:00（延長可・指名のみ）",
+            "room": f"ルーム{i:02d}（新宿三丁目駅前ビル7階）",
+        }
+        for d in range(days)
+        for i in range(per_day)
+    ]
+
+
+def bubble_bytes(message):
+    """送信時と同じくSDKのto_dict()をJSONにした大きさ"""
+    return len(json.dumps(message.contents.to_dict()).encode("utf-8"))
+
+
+def test_worst_case_fits_in_one_bubble():
+    shifts = make_shifts(app.MAX_UPCOMING_DAYS, 5)
+    message = app.build_upcoming_shifts_flex(shifts, app.MAX_UPCOMING_DAYS)
+    assert bubble_bytes(message) < LINE_BUBBLE_MAX_BYTES
+
+
+def test_oversized_input_is_truncated_with_count():
+    shifts = make_shifts(31, 20)
+    message = app.build_upcoming_shifts_flex(shifts, 31)
+    assert bubble_bytes(message) < LINE_BUBBLE_MAX_BYTES
+    texts = [c.get("text", "") for c in message.contents.to_dict()["body"]["contents"]]
+    assert any(t.startswith("…ほか") for t in texts)
+
+
+def test_small_input_is_not_truncated():
+    shifts = make_shifts(7, 2)
+    content, omitted = app.build_upcoming_shifts_rows(shifts, app.UPCOMING_FLEX_MAX_BYTES)
+    assert omitted == 0
+    assert sum(1 for row in content if row["type"] == "box") == len(shifts)
+
+
+class FixedDate(date):
+    @classmethod
+    def today(cls):
+        return cls(2026, 11, 1)
+
+
+def test_shift_started_last_month_is_included(monkeypatch):
+    # 10/30〜11/2のシフトは10月のインデックスにだけ入っている
+    indexes = {
+        (2026, 10): app.build_shift_date_index([{
+            "therapist": "さくら", "start_date": "2026-10-30", "end_date": "2026-11-02",
+            "condition": "12:00-20:00", "room": "A"}]),
+        (2026, 11): app.build_shift_date_index([{
+            "therapist": "もも", "start_date": "2026-11-03", "end_date": "",
+            "condition": "12:00-20:00", "room": "B"}]),
+    }
+    monkeypatch.setattr(app, "NOTION_API_KEY", "test")
+    monkeypatch.setattr(app, "date", FixedDate)
+    monkeypatch.setattr(app.shift_cache, "get_index", lambda year, month: indexes.get((year, month), ([], [])))
+
+    shifts = app.fetch_upcoming_shifts(days=7)
+
+    assert [(s["date"], s["name"]) for s in shifts] == [
+        ("2026-11-01", "さくら"), ("2026-11-02", "さくら"), ("2026-11-03", "もも")]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+トレース（TRACE_DIR の traces-<pid>.jsonl）から処理時間の長いWebhookイベントを表示する
+各トレースはスパンの入れ子をウォーターフォールで表示する（開始オフセット・所要時間・属性）
+
+    python tools/slow_traces.py [--dir data/traces] [--top 10] [--command schedule] [--since 60] [--errors]
+
+ローテーション済みのファイル（traces-<pid>.jsonl.1 など）も含めて読む。
+"""
+
+import os
+import sys
+import glob
+import json
+import heapq
+import argparse
+from datetime import datetime, timedelta
+
+BAR_WIDTH = 40
+
+
+def read_traces(directory):
+    """ディレクトリ内の全トレースを1件ずつ返す（壊れた行は読み飛ばす）"""
+    for path in sorted(glob.glob(os.path.join(directory, "traces-*.jsonl*"))):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def trace_command(trace):
+    """ハンドラのスパンに付いたコマンド名（テキストメッセージ以外はイベント種別）"""
+    for span in trace["spans"]:
+        command = span.get("attrs", {}).get("command")
+        if command:
+            return command
+    return trace["spans"][0].get("attrs", {}).get("event_type", "")
+
+
+def matches(trace, args, since):
+    if args.command and trace_command(trace) != args.command:
+        return False
+    if args.errors and not any(span.get("error") for span in trace["spans"]):
+        return False
+    if since and datetime.fromisoformat(trace["start"]) < since:
+        return False
+    return trace["duration_ms"] >= args.min_ms
+
+
+def format_attrs(attrs):
+    return " ".join(f"{key}={value}" for key, value in attrs.items())
+
+
+def print_waterfall(trace):
+    total = max(trace["duration_ms"], 0.001)
+    children = {}
+    for span in trace["spans"]:
+        children.setdefault(span["parent"], []).append(span)
+
+    def walk(span, depth):
+        start = int(span["offset_ms"] / total * BAR_WIDTH)
+        width = max(1, int(span["duration_ms"] / total * BAR_WIDTH))
+        bar = " " * start + "█" * min(width, BAR_WIDTH - start)
+        label = "  " * depth + span["name"]
+        line = f"  {span['offset_ms']:9.1f} {span['duration_ms']:9.1f}  {bar:<{BAR_WIDTH}}  {label}"
+        if span.get("attrs"):
+            line += f"  {format_attrs(span['attrs'])}"
+        if span.get("error"):
+            line += f"  !! {span['error']}"
+        print(line)
+        for child in sorted(children.get(span["id"], []), key=lambda s: s["offset_ms"]):
+            walk(child, depth + 1)
+
+    print(f"  {'start ms':>9} {'dur ms':>9}")
+    for root in children.get(None, []):
+        walk(root, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=os.environ.get("TRACE_DIR", "data/traces"), help="トレースのディレクトリ")
+    parser.add_argument("--top", type=int, default=10, help="表示する件数")
+    parser.add_argument("--command", help="コマンド名（/metrics の command ラベル）またはイベント種別で絞り込む")
+    parser.add_argument("--min-ms", type=float, default=0, help="この時間（ms）以上のトレースだけを対象にする")
+    parser.add_argument("--since", type=float, help="直近この分数のトレースだけを対象にする")
+    parser.add_argument("--errors", action="store_true", help="エラーのあるスパンを含むトレースだけを対象にする")
+    parser.add_argument("--no-waterfall", action="store_true", help="一覧だけを表示する")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        parser.error(f"trace directory not found: {args.dir} (set TRACE_SAMPLE_RATE to record traces)")
+    since = datetime.now() - timedelta(minutes=args.since) if args.since else None
+
+    scanned = 0
+
+    def candidates():
+        nonlocal scanned
+        for trace in read_traces(args.dir):
+            scanned += 1
+            if matches(trace, args, since):
+                yield trace
+
+    slowest = heapq.nlargest(args.top, candidates(), key=lambda t: t["duration_ms"])
+    print(f"{len(slowest)} slowest of {scanned} traces in {args.dir}")
+    print(f"{'dur ms':>9}  {'start':<23}  {'command':<16}  trace_id")
+    for trace in slowest:
+        error = "  error" if any(span.get("error") for span in trace["spans"]) else ""
+        print(f"{trace['duration_ms']:9.1f}  {trace['start']:<23}  {trace_command(trace):<16}  {trace['trace_id']}{error}")
+
+    if not args.no_waterfall:
+        for trace in slowest:
+            print()
+            print(f"{trace['trace_id']}  {trace_command(trace)}  {trace['duration_ms']:.1f} ms  ({trace['start']}, pid {trace['pid']})")
+            print_waterfall(trace)
+
+
+if __name__ == "__main__":
+    sys.exit(main())